@@ -1,23 +1,68 @@
 import serial
-import binascii
 import ConfigParser
 import numpy as np
 import time
-
-
-def hex2Ascii(hexStr):
-    """ Convert hex to ascii string """
-    asciiStr = ''
-    for i in range(len(hexStr)/2):
-            asciiStr += binascii.a2b_hex(hexStr[2*i] + hexStr[2*i+1])
-    return asciiStr
-
-
-def ascii2Hex(asciiStr):
-        hexStr = ''
-        for i in range(len(asciiStr)):
-                hexStr += hex(ord(asciiStr[i]))
-        return hexStr
+import threading
+import Queue
+from metrics import registry, timed
+import t255protocol
+from t255protocol import hex2Ascii, ascii2Hex
+
+
+ask_time = registry.histogram('t255_ask_seconds',
+                              'Duration of T255 command/reply exchanges')
+serial_errors = registry.counter('t255_serial_errors_total',
+                                 'Failed reads and writes of the serial port')
+limit_hits = registry.counter('t255_temperature_limit_hits_total',
+                              'Corrections refused by the temperature limits')
+
+
+class CommandFuture:
+    """ Result of a command executed by the serial worker """
+    def __init__(self):
+        self._event = threading.Event()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        """ Wait for the command and return its result. Raises the exception
+        of the command if it failed """
+        if not self._event.wait(timeout):
+            raise RuntimeError('Command did not finish in time')
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise RuntimeError('Command did not finish in time')
+        return self._exception
+
+    def add_done_callback(self, fn):
+        """ Call fn(future) when the command finished, from the worker
+        thread, or immediately if it already finished """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _finish(self, result=None, exception=None):
+        with self._lock:
+            self._result = result
+            self._exception = exception
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception as e:
+                print "Error in command callback: %s" % e
 
 
 class Regulator:
@@ -65,36 +110,120 @@ class Regulator:
 class T255Controller(Regulator):
     """ T255 temperature controller regulator """
 
+    lower_temperature_limit = 17.5
+    higher_temperature_limit = 17.9
+    temperature_step = 0.1
+    # seconds between checks of the cached set temperature, run by the
+    # scheduler of the feedback loop
+    reconcile_interval = 60.
+
     commands = {
-        'read_coolant_temperature': hex2Ascii('2E4937370D'),
-        'read_set_temperature': hex2Ascii('2E483041360D')
+        'read_coolant_temperature':
+            t255protocol.QUERIES['coolant_temperature'],
+        'read_set_temperature': t255protocol.QUERIES['set_temperature']
                }
     def __init__(self, comport = 'COM11'):
         self.comport = comport
 
-        self.lower_temperature_limit = 17.5
-        self.higher_temperature_limit = 17.9
-        self.temperature_step = 0.1
+        # last known set temperature, None when it has to be read again
+        self._set_temperature = None
+        # last read coolant temperature, None when unknown
+        self.coolant_temperature = None
 
         self.serial = serial.Serial(port = self.comport, timeout=0.7)
-        
-   
+        # a write and the reply must not be interleaved with other commands
+        self._serial_lock = threading.RLock()
+        self._queue = Queue.Queue()
+        self._worker = None
+
+    def start_worker(self):
+        """ Start a thread that executes submitted commands, so that callers
+        do not have to wait for the serial port """
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._work,
+                                            name='T255 %s' % self.comport)
+            self._worker.setDaemon(True)
+            self._worker.start()
+
+    def stop_worker(self):
+        """ Finish the queued commands and stop the worker """
+        if self._worker is not None:
+            self._queue.put(None)
+            self._worker.join()
+            self._worker = None
+
+    def submit(self, method, *args):
+        """ Queue method(*args) for the worker and return a CommandFuture """
+        future = CommandFuture()
+        self._queue.put((future, method, args))
+        if self._worker is None:
+            self.start_worker()
+        return future
+
+    def _work(self):
+        while True:
+            # blocks without polling, reconcile is submitted by the caller,
+            # e.g. every reconcile_interval by the scheduler of the loop
+            command = self._queue.get()
+            if command is None:
+                return
+            future, method, args = command
+            try:
+                future._finish(result=method(*args))
+            except Exception as e:
+                future._finish(exception=e)
+
     def close(self):
+        self.stop_worker()
         self.serial.close()
     
     def readCoolantTemperature(self):
         """ Return coolant temperature """
-        command = self.commands['read_coolant_temperature']
-        return float(self.ask(command)[3:8])/100
+        return self._query_one('coolant_temperature')
 
+    @timed(ask_time)
     def ask(self, command):
-        self.write(command)
-        return self.readline()
+        with self._serial_lock:
+            self.write(command)
+            return self.readline()
+
+    @timed(ask_time)
+    def query(self, *names):
+        """ Send the queries names of t255protocol.QUERIES in one write and
+        read all replies, e.g. query('set_temperature', 'coolant_temperature')
+
+        Returns the values by name, the value of a failed query is a
+        ValueError. The cached temperatures are updated.
+        """
+        frames = ''.join([t255protocol.QUERIES[name] for name in names])
+        with self._serial_lock:
+            self.write(frames)
+            replies = [self.readline() for name in names]
+        values = t255protocol.demultiplex(names, replies)
+        if 'set_temperature' in values:
+            value = values['set_temperature']
+            if isinstance(value, ValueError):
+                self.invalidate()
+            else:
+                self._set_temperature = value
+        if 'coolant_temperature' in values:
+            value = values['coolant_temperature']
+            self.coolant_temperature = None if \
+                isinstance(value, ValueError) else value
+        return values
+
+    def _query_one(self, name):
+        value = self.query(name)[name]
+        if isinstance(value, ValueError):
+            raise value
+        return value
 
     def readline(self):
+        """ Read a reply, up to the carriage return that ends it """
         try:
-            return self.serial.readline()
+            return t255protocol.read_reply(self.serial)
         except:
+            serial_errors.inc()
             print "Error reading serial device"
             return ''
 
@@ -102,14 +231,43 @@ class T255Controller(Regulator):
         try:
             return self.serial.read()
         except:
+            serial_errors.inc()
             print "Error reading serial device"
             return ''
 
     def getSetTemperature(self):
-        """ Return set temperature """
-        command = self.commands['read_set_temperature']
-        #return hex2Ascii(self.ask(command)[1:])
-        return float(self.ask(command)[4:8])/10.
+        """ Return set temperature, read from the device """
+        return self._query_one('set_temperature')
+
+    def getCachedSetTemperature(self):
+        """ Return the last known set temperature, only read it from the
+        device when it is not known """
+        if self._set_temperature is None:
+            return self.getSetTemperature()
+        return self._set_temperature
+
+    def lastSetTemperature(self):
+        """ Return the cached set temperature without reading the device,
+        None when it is not known """
+        return self._set_temperature
+
+    def invalidate(self):
+        """ Forget the cached set temperature """
+        self._set_temperature = None
+
+    def reconcile(self):
+        """ Compare the cached set temperature with the device, and update
+        the coolant temperature """
+        cached = self._set_temperature
+        # both values in one exchange
+        values = self.query('set_temperature', 'coolant_temperature')
+        actual = values['set_temperature']
+        if isinstance(actual, ValueError):
+            print "Could not read set temperature"
+        elif cached is not None and abs(cached - actual) > 1e-6:
+            print "Set temperature changed from %.1f to %.1f" % (cached, actual)
+        if isinstance(values['coolant_temperature'], ValueError):
+            print "Could not read coolant temperature"
 
     def setTemperature(self, temperature):
         """ Set the temperature to temperature degrees """
@@ -119,26 +277,14 @@ class T255Controller(Regulator):
             message = 'Lower Lim: desired T: %.2f' % temperature
             raise TemperatureLimitException(message)
 
-        temp = int(round(10*temperature))
-        
-        # split up in three parts
-        temp10 = str(temp/100%10) # temperature in tens of degrees
-        temp1  = str(temp/10%10)  # one degrees
-        temp01 = str(temp%10)     # .1 degrees
-
-        # calculate checksum
-        checksum_int =  (46 + 77 +  43 + ord(temp10) +  ord(temp1) +  ord(temp01))%256
-
-        set_temperature_command = '.M+' + str(temp) + hex(checksum_int)[2:] + '\r'
-        # write command
-        self.write(set_temperature_command)
-        
-        # read new set temperature
-        settemp = self.readline()
+        # write command and read new set temperature
+        settemp = self.ask(t255protocol.set_temperature_frame(temperature))
         try:
-            settemp = float(settemp[4:7])/10.
+            settemp = t255protocol.parse('new_set_temperature', settemp)
+            self._set_temperature = settemp
             print "new set temp: %f" % settemp
-        except: 
+        except ValueError:
+            self.invalidate()
             print "Could not set temp"
 
 
@@ -146,24 +292,39 @@ class T255Controller(Regulator):
         try:
             self.serial.write(command)
         except:
+            serial_errors.inc()
             print "Error writing. "
 
     def lower_temperature(self):
         try:
-            self.setTemperature(self.getSetTemperature()-self.temperature_step)
+            self.setTemperature(self.getCachedSetTemperature()-self.temperature_step)
             return True
         except TemperatureLimitException as e:
+            limit_hits.inc()
             print e
             return False
 
     def raise_temperature(self):
         try:
-            self.setTemperature(self.getSetTemperature()+self.temperature_step)
+            self.setTemperature(self.getCachedSetTemperature()+self.temperature_step)
             return True
         except TemperatureLimitException as e:
+            limit_hits.inc()
             print e
             return False
 
+    def lower_temperature_async(self):
+        """ Lower the temperature in the worker. Returns a CommandFuture """
+        return self.submit(self.lower_temperature)
+
+    def raise_temperature_async(self):
+        """ Raise the temperature in the worker. Returns a CommandFuture """
+        return self.submit(self.raise_temperature)
+
+    def set_temperature_async(self, temperature):
+        """ Set the temperature in the worker. Returns a CommandFuture """
+        return self.submit(self.setTemperature, temperature)
+
 class TemperatureLimitException(Exception):
     def __init__(self, string):
         self.message = string
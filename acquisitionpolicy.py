@@ -0,0 +1,66 @@
+class AdaptiveAcquisition:
+    """ Switch a feedbackLoop between a sparse and a dense acquisition.
+
+    While the loop is locked and the signal is well within its bounds it
+    reads at a low clock speed and a long period, which saves USB traffic
+    and CPU. Near the bounds, out of them, when not locked or shortly after
+    a change of the lock state it reads densely and often, so it reacts
+    faster. It only goes back to sparse after hold_time seconds without a
+    reason to be dense.
+
+    A profile is a dict with the clockspeed (S/s), the num_samples per read
+    and the period (s) of the loop stages. Switching restarts the DAQ task,
+    so the profiles should not be too close to make it switch often.
+
+    Example:
+    loop = feedbackLoop(adaptive_acquisition=True)
+    loop.acquisition_policy.sparse['period'] = 1.
+    """
+
+    SPARSE = 'sparse'
+    DENSE = 'dense'
+
+    def __init__(self, sparse=None, dense=None, margin=0.2, hold_time=10.):
+        """
+        arguments:
+        sparse, dense -- profiles, see above
+        margin        -- distance to a bound, as a fraction of the distance
+                         between the bounds, below which to read densely
+        hold_time     -- s to stay dense after the last reason
+        """
+        if sparse is None:
+            sparse = {'clockspeed': 1000., 'num_samples': 10, 'period': 0.5}
+        if dense is None:
+            dense = {'clockspeed': 10000., 'num_samples': 10, 'period': 0.05}
+        self.sparse = sparse
+        self.dense = dense
+        self.margin = margin
+        self.hold_time = hold_time
+        self.mode = None
+        self._lock_state = None
+        self._alert_time = None  # last time there was a reason to be dense
+
+    def choose(self, signal, lock_state, min_signal, max_signal, now):
+        """ Return SPARSE or DENSE for the current signal and lock state """
+        margin = self.margin * (max_signal - min_signal)
+        alert = (lock_state != 1 or lock_state != self._lock_state or
+                 signal < min_signal + margin or
+                 signal > max_signal - margin)
+        self._lock_state = lock_state
+        if alert:
+            self._alert_time = now
+            return self.DENSE
+        if self._alert_time is not None and \
+                now - self._alert_time < self.hold_time:
+            return self.DENSE
+        return self.SPARSE
+
+    def update(self, loop, now):
+        """ Reconfigure loop when the mode changes """
+        mode = self.choose(loop.signal_mean, loop.lock_state,
+                           loop.min_signal, loop.max_signal, now)
+        if mode != self.mode:
+            self.mode = mode
+            profile = self.dense if mode == self.DENSE else self.sparse
+            loop.reconfigure_acquisition(**profile)
+        return mode
@@ -0,0 +1,269 @@
+import os
+import glob
+import numpy as np
+
+MAGIC = 7255.0  # first value of every archive file
+HEADER = 5  # magic, columns, rows per file, rows per chunk, number of rows
+
+
+class ArchiveFile:
+    """ One memory-mapped file of a TelemetryArchive.
+
+    Layout, all float64: the header, the sparse index holding the time of
+    the first row of every chunk, and then the columns one after the other,
+    each rows_per_file long.
+    """
+    def __init__(self, path, num_columns=None, rows_per_file=None,
+                 chunk_rows=None, readonly=False):
+        self.path = path
+        if os.path.exists(path):
+            header = np.memmap(path, dtype=np.float64, mode='r', shape=(HEADER,))
+            if header[0] != MAGIC:
+                raise IOError('%s is not an archive file' % path)
+            num_columns = int(header[1])
+            rows_per_file = int(header[2])
+            chunk_rows = int(header[3])
+            del header
+            mode = 'r' if readonly else 'r+'
+        else:
+            mode = 'w+'
+        self.num_columns = num_columns
+        self.rows_per_file = rows_per_file
+        self.chunk_rows = chunk_rows
+        num_chunks = -(-rows_per_file // chunk_rows)
+        size = HEADER + num_chunks + num_columns * rows_per_file
+
+        self._map = np.memmap(path, dtype=np.float64, mode=mode, shape=(size,))
+        self._header = self._map[:HEADER]
+        self.index = self._map[HEADER:HEADER + num_chunks]
+        self.columns = self._map[HEADER + num_chunks:].reshape(num_columns,
+                                                               rows_per_file)
+        if mode == 'w+':
+            self._header[:] = (MAGIC, num_columns, rows_per_file, chunk_rows, 0)
+
+    @property
+    def count(self):
+        """ Number of rows in the file """
+        return int(self._header[4])
+
+    @property
+    def full(self):
+        return self.count >= self.rows_per_file
+
+    def first_time(self):
+        return self.columns[0, 0] if self.count else None
+
+    def last_time(self):
+        count = self.count
+        return self.columns[0, count - 1] if count else None
+
+    def append(self, rows):
+        """ Append the rows (columns, n) that fit, return how many did """
+        count = self.count
+        n = min(rows.shape[1], self.rows_per_file - count)
+        self.columns[:, count:count + n] = rows[:, :n]
+        # index the chunks that start in the new rows
+        first_chunk = -(-count // self.chunk_rows)
+        last_chunk = (count + n - 1) // self.chunk_rows
+        for chunk in range(first_chunk, last_chunk + 1):
+            self.index[chunk] = self.columns[0, chunk * self.chunk_rows]
+        # publish the rows after they are written
+        self._header[4] = count + n
+        return n
+
+    def append_row(self, row):
+        """ Append a single row, without creating an array for it """
+        count = self.count
+        for column, value in enumerate(row):
+            self.columns[column, count] = value
+        if count % self.chunk_rows == 0:
+            self.index[count // self.chunk_rows] = row[0]
+        self._header[4] = count + 1
+
+    def row_range(self, start, stop):
+        """ Return the rows with start <= time <= stop as (first, last) """
+        count = self.count
+        if count == 0:
+            return 0, 0
+        num_chunks = -(-count // self.chunk_rows)
+        index = self.index[:num_chunks]
+        # narrow down to whole chunks with the sparse index, then search
+        # only the time column of those chunks
+        # the chunk before the first one starting at start can end with
+        # rows at time start too
+        first_chunk = max(np.searchsorted(index, start, side='left') - 1, 0)
+        last_chunk = np.searchsorted(index, stop, side='right')
+        lo = first_chunk * self.chunk_rows
+        hi = min(last_chunk * self.chunk_rows, count)
+        times = self.columns[0, lo:hi]
+        return (lo + np.searchsorted(times, start, side='left'),
+                lo + np.searchsorted(times, stop, side='right'))
+
+    def flush(self):
+        self._map.flush()
+
+    def close(self):
+        """ Unmap the file """
+        if self._map.mode != 'r':
+            self.flush()
+        self._map = self._header = self.index = self.columns = None
+
+    @staticmethod
+    def time_range(path):
+        """ Return the (first, last) time in the file at path, or None when
+        it is empty, reading only the header and the two values """
+        with open(path, 'rb') as f:
+            header = np.fromfile(f, dtype=np.float64, count=HEADER)
+            if len(header) < HEADER or header[0] != MAGIC:
+                raise IOError('%s is not an archive file' % path)
+            rows_per_file, chunk_rows, count = [int(value)
+                                                for value in header[2:]]
+            if count == 0:
+                return None
+            times = 8 * (HEADER + -(-rows_per_file // chunk_rows))
+            f.seek(times)
+            first = np.fromfile(f, dtype=np.float64, count=1)[0]
+            f.seek(times + 8 * (count - 1))
+            last = np.fromfile(f, dtype=np.float64, count=1)[0]
+        return first, last
+
+
+class TelemetryArchive:
+    """ Append-only columnar archive of time series in memory-mapped files.
+
+    Rows are appended to a preallocated file of rows_per_file rows; when it
+    is full a new file is started. Every chunk_rows rows the time of the
+    row is stored in a sparse index, so a time range is found by searching
+    the index and a single chunk instead of the whole file. Queries only
+    touch the pages of the requested range. The first column is the time
+    and has to be non-decreasing.
+
+    Only the last file stays mapped. Older files are found by their first
+    and last time, which are read once, and are mapped only while a query
+    reads them, so the address space does not grow with the archive.
+
+    Example:
+    archive = TelemetryArchive('telemetry', ('time', 'signal'))
+    archive.append((time.time(), 3.1))
+    data = archive.query(time.time() - 3600, time.time())
+    plot(data['time'], data['signal'])
+    """
+
+    def __init__(self, directory, columns, rows_per_file=2**20,
+                 chunk_rows=1024, readonly=False, prefix='telemetry'):
+        """ Open or create the archive in directory.
+
+        arguments:
+        columns       -- names of the columns, the first one is the time
+        rows_per_file -- rows in every file before rotating to a new one
+        chunk_rows    -- rows per entry of the sparse time index
+        readonly      -- open existing files for queries only
+        """
+        self.directory = directory
+        self.column_names = tuple(columns)
+        self.rows_per_file = rows_per_file
+        self.chunk_rows = chunk_rows
+        self.readonly = readonly
+        self.prefix = prefix
+        if not readonly and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.paths = []  # all files, oldest first
+        self._ranges = {}  # (first, last) time of the full files by path
+        self.current = None  # ArchiveFile of the last path, mapped
+        self._scan()
+
+    def _path(self, number):
+        return os.path.join(self.directory, '%s_%06i.tfa' % (self.prefix,
+                                                             number))
+
+    def _scan(self):
+        """ Find the files that were added, and map the last one """
+        pattern = os.path.join(self.directory, '%s_*.tfa' % self.prefix)
+        paths = sorted(glob.glob(pattern))
+        if len(paths) > len(self.paths):
+            self.paths = paths
+            self._set_current(self._open(paths[-1]))
+
+    def _set_current(self, archive_file):
+        if self.current is not None:
+            if self.current.full:
+                self._ranges[self.current.path] = (self.current.first_time(),
+                                                   self.current.last_time())
+            self.current.close()
+        self.current = archive_file
+
+    def _open(self, path, readonly=None):
+        if readonly is None:
+            readonly = self.readonly
+        archive_file = ArchiveFile(path, len(self.column_names),
+                                   self.rows_per_file, self.chunk_rows,
+                                   readonly=readonly)
+        if archive_file.num_columns != len(self.column_names):
+            raise IOError('%s has %i columns instead of %i' % (
+                path, archive_file.num_columns, len(self.column_names)))
+        return archive_file
+
+    def _writable_file(self):
+        if self.current is None or self.current.full:
+            path = self._path(len(self.paths))
+            self._set_current(self._open(path))
+            self.paths.append(path)
+        return self.current
+
+    def _time_range(self, path):
+        if path not in self._ranges:
+            time_range = ArchiveFile.time_range(path)
+            if time_range is None:
+                return None
+            # a file that is not the last one does not change any more
+            self._ranges[path] = time_range
+        return self._ranges[path]
+
+    def append(self, row):
+        """ Append one row, a sequence with a value for every column """
+        self._writable_file().append_row(row)
+
+    def extend(self, rows):
+        """ Append the rows of an array of shape (columns, n) """
+        rows = np.asarray(rows, dtype=np.float64)
+        while rows.shape[1]:
+            n = self._writable_file().append(rows)
+            rows = rows[:, n:]
+
+    def query(self, start, stop, columns=None):
+        """ Return a dict of arrays with the rows with start <= time <= stop
+
+        arguments:
+        columns -- names of the columns to return, default all
+        """
+        if self.readonly:
+            self._scan()
+        if columns is None:
+            columns = self.column_names
+        indices = [self.column_names.index(name) for name in columns]
+
+        parts = []
+        for path in self.paths[:-1]:
+            time_range = self._time_range(path)
+            if time_range is None or time_range[0] > stop or \
+                    time_range[1] < start:
+                continue
+            archive_file = self._open(path, readonly=True)
+            parts.append(self._rows(archive_file, start, stop, indices))
+            archive_file.close()
+        if self.current is not None and self.current.count:
+            parts.append(self._rows(self.current, start, stop, indices))
+        if parts:
+            data = np.concatenate(parts, axis=1)
+        else:
+            data = np.zeros((len(indices), 0))
+        return dict(zip(columns, data))
+
+    def _rows(self, archive_file, start, stop, indices):
+        lo, hi = archive_file.row_range(start, stop)
+        return np.array(archive_file.columns[indices, lo:hi])
+
+    def flush(self):
+        """ Write the changes of the current file to disk """
+        if self.current is not None:
+            self.current.flush()
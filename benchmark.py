@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+""" Benchmark of the feedback loop against a fake chiller and a simulated DAQ.
+
+The real T255Controller talks over a Linux pseudo-terminal to FakeT255, which
+runs in its own process and answers the .I77, .H0A6 and .M+ commands after a
+configurable latency. The DAQ is a SimulatedDAQ. Two measurements:
+
+hot path -- acquire, lock detection and regulation called back to back on a
+            non-realtime DAQ: iterations per second, CPU time and the net
+            growth of the objects tracked by the garbage collector per
+            iteration, a leak check.
+latency  -- the loop runs on its scheduler while the signal is stepped out
+            of bounds; the time from the step until the .M+ command reaches
+            the chiller.
+
+Allocation counts are not reported: Python 2.7 has no allocation hook
+(tracemalloc, sys.getallocatedblocks) and release builds do not count
+allocations, so only the leak check is available.
+
+Usage:
+    python benchmark.py
+    python benchmark.py --latency 0.05 --period 0.01 --trials 50
+    python benchmark.py --min-rate 5000 --max-latency 0.1  # exit 1 if not met
+"""
+import argparse
+import gc
+import logging
+import multiprocessing
+import os
+import Queue
+import sys
+import time
+import numpy as np
+from scheduler import monotonic
+
+
+def _checksum(text):
+    return '%02x' % (sum(ord(c) for c in text) % 256)
+
+
+def _serve(connection, events, latency, set_temperature, coolant_temperature):
+    """ Answer T255 commands on a new pty, send its name over connection """
+    master, slave = os.openpty()
+    connection.send(os.ttyname(slave))
+    pending = ''
+    while True:
+        try:
+            pending += os.read(master, 1024)
+        except OSError:
+            return
+        while '\r' in pending:
+            command, pending = pending.split('\r', 1)
+            if latency:
+                time.sleep(latency)
+            if command == '.I77':
+                reply = '.I+%05d' % round(coolant_temperature * 100)
+            elif command == '.H0A6':
+                reply = '.H+%05d' % round(set_temperature * 10)
+            elif command.startswith('.M+') and \
+                    _checksum(command[:6]) == command[6:].zfill(2):
+                set_temperature = int(command[3:6]) / 10.
+                events.put((monotonic(), set_temperature))
+                reply = '.M+%04d' % int(command[3:6])
+            else:
+                reply = '.E'
+            os.write(master, reply + _checksum(reply) + '\r')
+
+
+class FakeT255:
+    """ T255 chiller on a pseudo-terminal, in a separate process so that it
+    does not show up in the CPU time of the loop.
+
+    Every accepted set temperature command puts (monotonic time, set
+    temperature) in corrections.
+
+    Example:
+    chiller = FakeT255(latency=0.02)
+    cooler = T255Controller(comport=chiller.port)
+    """
+
+    def __init__(self, latency=0.01, set_temperature=17.7,
+                 coolant_temperature=17.5):
+        self.corrections = multiprocessing.Queue()
+        parent, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=_serve, args=(child, self.corrections, latency,
+                                 set_temperature, coolant_temperature))
+        self.process.daemon = True
+        self.process.start()
+        self.port = parent.recv()
+
+    def close(self):
+        self.process.terminate()
+        self.process.join()
+
+
+def _create_loop(chiller, realtime, clockspeed, block_size, period,
+                 within_bounds_time):
+    from daqmx_channel import daqmx_channel_in
+    from daqmx_sim import SimulatedDAQ
+    from T255Controller import T255Controller
+    from temperatureFeedback import feedbackLoop
+
+    daq = SimulatedDAQ(realtime=realtime, block_size=block_size, seed=0)
+    laser = daq.laser()
+    laser.gain = 0.
+    laser.drift_amplitude = 0.
+    channel = daqmx_channel_in(clockspeed=clockspeed,
+                               num_samples=feedbackLoop.num_samples,
+                               continuous=True,
+                               buffer_size=max(block_size, int(clockspeed)),
+                               backend=daq)
+    loop = feedbackLoop(PID_output=channel,
+                        cooler=T255Controller(comport=chiller.port),
+                        archive_directory=None,
+                        acquisition_period=period, lock_period=period,
+                        feedback_period=period,
+                        PID_within_bounds_time=within_bounds_time)
+    loop.logger.setLevel(logging.WARNING)
+    loop.active = True
+    return loop, laser
+
+
+def _close_loop(loop):
+    loop.cooler.close()
+    loop.PID_output.cleanup()
+
+
+def _cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+
+def hot_path(chiller, iterations=20000, clockspeed=1e5, block_size=1000):
+    """ Run the stages of one loop iteration back to back, without waiting
+    for the DAQ or the scheduler. The signal stays within bounds, so there
+    is no serial traffic.
+
+    return:
+        dict with iterations_per_second, cpu_per_iteration (s) and
+        object_growth_per_iteration, the net growth of the number of objects
+        tracked by the garbage collector, a leak check: objects that are
+        freed again, numpy arrays and floats are not counted
+    """
+    loop, laser = _create_loop(chiller, False, clockspeed, block_size, 1.,
+                               1.)
+    try:
+        def iteration():
+            loop.acquire()
+            loop.update_lock_state()
+            loop.regulate()
+        # warm up: buffers, caches and the first lock state
+        for i in range(100):
+            iteration()
+
+        gc.collect()
+        gc.disable()
+        objects = len(gc.get_objects())
+        cpu = _cpu_time()
+        start = monotonic()
+        for i in xrange(iterations):
+            iteration()
+        elapsed = monotonic() - start
+        cpu = _cpu_time() - cpu
+        objects = len(gc.get_objects()) - objects
+        gc.enable()
+    finally:
+        _close_loop(loop)
+    return {'iterations_per_second': iterations / elapsed,
+            'cpu_per_iteration': cpu / iterations,
+            'object_growth_per_iteration': float(objects) / iterations}
+
+
+def correction_latency(chiller, trials=20, period=0.01, clockspeed=1e4,
+                       timeout=2.):
+    """ Step the simulated signal out of bounds, alternately above and
+    below, and measure until the chiller receives the correction.
+
+    return:
+        dict with the latencies (s) array, the number of trials without a
+        correction within timeout, and iterations_per_second and
+        cpu_per_iteration of the running loop
+    """
+    within_bounds_time = 2 * period
+    loop, laser = _create_loop(chiller, True, clockspeed, 0, period,
+                               within_bounds_time)
+    nominal = laser.offset
+    latencies = []
+    timeouts = 0
+    cpu = _cpu_time()
+    start = monotonic()
+    loop.start()
+    try:
+        # wait for the loop to see the lock, and for the first reads of the
+        # chiller to finish
+        while (loop.lock_state != 1 or
+               loop.cooler.coolant_temperature is None) and \
+                monotonic() - start < 2 * timeout:
+            time.sleep(period)
+        for trial in range(trials):
+            if trial % 2:
+                laser.offset = loop.min_signal - 0.5
+            else:
+                laser.offset = loop.max_signal + 0.5
+            stepped = monotonic()
+            try:
+                corrected, temperature = chiller.corrections.get(
+                    timeout=timeout)
+                latencies.append(corrected - stepped)
+            except Queue.Empty:
+                timeouts += 1
+            else:
+                # let the controller read the reply before the next step
+                while loop.cooler.lastSetTemperature() != temperature and \
+                        monotonic() - corrected < timeout:
+                    time.sleep(period)
+            laser.offset = nominal
+            time.sleep(within_bounds_time + 3 * period)
+    finally:
+        loop.scheduler.stop()
+        loop.join()
+        elapsed = monotonic() - start
+        cpu = _cpu_time() - cpu
+        _close_loop(loop)
+    runs = max(loop.timing()['acquisition']['runs'], 1)
+    return {'latencies': np.array(latencies),
+            'timeouts': timeouts,
+            'iterations_per_second': runs / elapsed,
+            'cpu_per_iteration': cpu / runs}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the feedback '
+                                     'loop against a fake T255 chiller')
+    parser.add_argument('--latency', type=float, default=0.01,
+                        help='reply latency of the fake chiller (s)')
+    parser.add_argument('--period', type=float, default=0.01,
+                        help='period of the loop stages (s)')
+    parser.add_argument('--trials', type=int, default=20,
+                        help='signal steps in the latency benchmark')
+    parser.add_argument('--iterations', type=int, default=20000,
+                        help='iterations of the hot path benchmark')
+    parser.add_argument('--clockspeed', type=float, default=1e5,
+                        help='simulated sample rate of the hot path (S/s)')
+    parser.add_argument('--block-size', type=int, default=1000,
+                        help='samples per read in the hot path')
+    parser.add_argument('--min-rate', type=float, default=None,
+                        help='fail below this many hot path iterations/s')
+    parser.add_argument('--max-latency', type=float, default=None,
+                        help='fail when the median latency exceeds this (s)')
+    args = parser.parse_args(argv)
+
+    chiller = FakeT255(latency=args.latency)
+    try:
+        hot = hot_path(chiller, args.iterations, args.clockspeed,
+                       args.block_size)
+        print "hot path (%i samples per iteration)" % args.block_size
+        print "  %10.0f iterations/s" % hot['iterations_per_second']
+        print "  %10.1f us CPU per iteration" % (
+            1e6 * hot['cpu_per_iteration'])
+        print "  %10.3f net GC-tracked objects per iteration (leak check)" % (
+            hot['object_growth_per_iteration'])
+
+        result = correction_latency(chiller, args.trials, args.period)
+        latencies = result['latencies']
+        print "signal to correction (period %g s, chiller latency %g s)" % (
+            args.period, args.latency)
+        if len(latencies):
+            print "  %10.1f ms median, %.1f ms 95%%, %.1f ms max" % (
+                1e3 * np.median(latencies),
+                1e3 * np.percentile(latencies, 95), 1e3 * latencies.max())
+        print "  %10i corrections missed" % result['timeouts']
+        print "  %10.0f iterations/s, %.1f us CPU per iteration" % (
+            result['iterations_per_second'],
+            1e6 * result['cpu_per_iteration'])
+    finally:
+        chiller.close()
+
+    failed = result['timeouts'] > 0
+    if args.min_rate is not None and \
+            hot['iterations_per_second'] < args.min_rate:
+        print "FAIL: hot path slower than %g iterations/s" % args.min_rate
+        failed = True
+    if args.max_latency is not None and (not len(latencies) or
+                                         np.median(latencies) >
+                                         args.max_latency):
+        print "FAIL: median latency above %g s" % args.max_latency
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -24,7 +24,26 @@ import ctypes
 import numpy
 import logging
 import time  # temporarly
-nidaq = ctypes.windll.nicaiu  # load the DLL
+from metrics import registry
+from scheduler import monotonic
+
+
+class _LazyLibrary:
+    """Load a DLL on first use, so importing this module is fast and does
+    not need the driver"""
+
+    def __init__(self, name):
+        self._name = name
+        self._library = None
+
+    def __getattr__(self, attribute):
+        if self._library is None:
+            self._library = getattr(ctypes.windll, self._name)  # load the DLL
+        function = getattr(self._library, attribute)
+        setattr(self, attribute, function)
+        return function
+
+nidaq = _LazyLibrary('nicaiu')
 
 ##############################
 # Setup some typedefs and constants
@@ -50,13 +69,171 @@ DAQmx_Val_FiniteSamps = 10178
 DAQmx_Val_GroupByChannel = 0
 DAQmx_Val_OnDemand = 10390  # On Demand
 DAQmx_Val_ContSamps = 10123
+DAQmx_Val_Acquired_Into_Buffer = 1  # Every N samples event type
 
 #*** Values for the Line Grouping parameter of DAQmxCreateDIChan and
 # DAQmxCreateDOChan ***
 DAQmx_Val_ChanPerLine = 0   # One Channel For Each Line
 DAQmx_Val_ChanForAllLines = 1   # One Channel For All Lines
+
+# prototype of the callback for DAQmxRegisterEveryNSamplesEvent
+DAQmxEveryNSamplesEventCallbackPtr = ctypes.CFUNCTYPE(int32, TaskHandle, int32,
+                                                      uInt32, ctypes.c_void_p)
 ##############################
 
+read_time = registry.histogram('daqmx_read_seconds',
+                               'Duration of reads of analog input channels')
+
+
+class NIDAQmxBackend:
+    """Driver calls of the channel classes, on the NI-DAQmx C library
+
+    A backend creates and runs tasks for daqmx_channel_in and
+    daqmx_digital_out. Another device, like the SimulatedDAQ of daqmx_sim,
+    only has to provide the same methods. Tasks are the handles returned by
+    create_ai_task and create_do_task.
+    """
+
+    samples_read = int32()  # samples per channel of the last read
+
+    def __init__(self):
+        # ctypes arguments of the read call, created once
+        self._read_timeout = float64(10.0)
+        self._read_ref = ctypes.byref(self.samples_read)
+
+    def CHK(self, err, warnings=False):
+        """a simple error checking routine"""
+        if err < 0 or (warnings and err > 0):
+            buf_size = 1000
+            buf = ctypes.create_string_buffer('\000' * buf_size)
+            nidaq.DAQmxGetErrorString(err, ctypes.byref(buf), buf_size)
+            kind = 'call failed with error' if err < 0 else \
+                'generated warning'
+            raise RuntimeError('nidaq %s %d: %s' % (kind, err,
+                                                    repr(buf.value)))
+
+    def create_ai_task(self, device, channels, v_lim, clockspeed, continuous,
+                       num_samples):
+        """Create a task measuring voltage on channels of device"""
+        taskHandle = TaskHandle(device * 8 + channels[0])
+        channel = ','.join(['Dev%i/ai%i' % (device, c) for c in channels])
+
+        # Send commands to initialize an analog input channel
+        self.CHK(nidaq.DAQmxCreateTask("", ctypes.byref(taskHandle)))
+        self.CHK(nidaq.DAQmxCreateAIVoltageChan(taskHandle, channel,
+                                           "",
+                                           DAQmx_Val_diff,
+                                           float64(v_lim[0]),
+                                           float64(v_lim[1]),
+                                           DAQmx_Val_Volts, None))
+        self.configure_timing(taskHandle, clockspeed, continuous, num_samples)
+        return taskHandle
+
+    def configure_timing(self, task, clockspeed, continuous, num_samples):
+        """Set the sample clock of a stopped task"""
+        # the sample count sets the buffer size in continuous mode
+        self.CHK(nidaq.DAQmxCfgSampClkTiming(task, "",
+                                        float64(clockspeed),
+                                        DAQmx_Val_Rising,
+                                        DAQmx_Val_ContSamps if continuous
+                                        else DAQmx_Val_FiniteSamps,
+                                        uInt64(num_samples)))
+
+    def create_do_task(self, device, port):
+        """Create a task writing all lines of port of device"""
+        addr = 'Dev%i/port%i/line0:7' % (device, port)
+        taskHandle = TaskHandle(device * 8 + port * 8)
+        self.CHK(nidaq.DAQmxCreateTask("", ctypes.byref(taskHandle)), True)
+        self.CHK(nidaq.DAQmxCreateDOChan(taskHandle,
+                                   addr,
+                                   "",
+                                   DAQmx_Val_ChanForAllLines
+                                   ), True)
+        return taskHandle
+
+    def start(self, task):
+        self.CHK(nidaq.DAQmxStartTask(task))
+
+    def stop(self, task):
+        nidaq.DAQmxStopTask(task)
+
+    def clear(self, task):
+        nidaq.DAQmxClearTask(task)
+
+    def is_done(self, task):
+        result = bool32(False)
+        self.CHK(nidaq.DAQmxIsTaskDone(task, ctypes.byref(result)))
+        return result.value
+
+    def wait_until_done(self, task, timeout):
+        self.CHK(nidaq.DAQmxWaitUntilTaskDone(task, float64(timeout)))
+
+    def samples_available(self, task):
+        available = uInt32()
+        self.CHK(nidaq.DAQmxGetReadAvailSampPerChan(task,
+                                                    ctypes.byref(available)))
+        return available.value
+
+    def read(self, task, num_samples, data):
+        """Read num_samples per channel into the float64 array data,
+        grouped by channel"""
+        self.CHK(nidaq.DAQmxReadAnalogF64(task,
+                                        num_samples,
+                                        self._read_timeout,
+                                        DAQmx_Val_GroupByChannel,
+                                        data.ctypes.data,
+                                        data.size,
+                                        self._read_ref, None))
+
+    def register_every_n_samples(self, task, num_samples, callback):
+        """Call callback() every num_samples acquired samples, from a
+        driver thread. Returns an object to keep alive while the task
+        runs"""
+        def every_n_samples(taskHandle, event_type, n_samples, data):
+            return callback()
+        # the caller keeps a reference, else ctypes frees the callback
+        function = DAQmxEveryNSamplesEventCallbackPtr(every_n_samples)
+        self.CHK(nidaq.DAQmxRegisterEveryNSamplesEvent(task,
+                                        DAQmx_Val_Acquired_Into_Buffer,
+                                        uInt32(num_samples),
+                                        0, function, None))
+        return function
+
+    def write_digital(self, task, data):
+        """Write one sample of the uint32 array data, one value per line"""
+        written = numpy.zeros_like(data)
+        self.CHK(nidaq.DAQmxWriteDigitalU32(task,
+                        1,  # numSampsPerCHan
+                        int32(1),  # autoStart
+                        float64(10.0),  # timeout
+                        DAQmx_Val_GroupByChannel,  # dataLayout
+                        data.ctypes.data,  # writeArray
+                        written.ctypes.data,  # writeArray
+                        None), True)
+
+
+_backend = None
+
+
+def get_backend():
+    """Return the backend used by channels created without one, by default
+    the NI-DAQmx driver"""
+    global _backend
+    if _backend is None:
+        _backend = NIDAQmxBackend()
+    return _backend
+
+
+def set_backend(backend):
+    """Use backend for all channels created from now on without one
+
+    Example:
+    from daqmx_sim import SimulatedDAQ
+    set_backend(SimulatedDAQ(realtime=False))
+    """
+    global _backend
+    _backend = backend
+
 
 class daqmx_channel_in:
     """Measure voltage on a channel of a NI-DAQ device, like USB6009
@@ -67,44 +244,58 @@ class daqmx_channel_in:
     channel1 = daqmx_channel(num_samples=nr_samples)  # ,clockspeed=48*1000)
     data = channel1.read_voltage()
     channel1.cleanup()
+
+    In continuous mode the task runs freely into an on-board buffer, every
+    read_voltage() returns the next num_samples samples without gaps and
+    read_available() drains everything acquired since the last read:
+    channel1 = daqmx_channel_in(num_samples=100, continuous=True)
+    data = channel1.read_available()
     """
 
-    read = int32()
     timeout = 1
+    grouped = False  # return (channels, samples) arrays
 
     def __init__(self, device=1, channel=0, clockspeed=10000.0, num_samples=10,
-                 v_lim=(-10.0, 10.0)):
+                 v_lim=(-10.0, 10.0), continuous=False, buffer_size=None,
+                 backend=None):
         """ Initialize channel to measure.
 
         arguments:
-        channel     -- Channel to measure IN1 on VU box means channel 0
+        channel     -- Channel to measure IN1 on VU box means channel 0, or a
+                       tuple of channels to measure in one task
         clockspeed  -- set some clockspeed
         num_samples -- number of points to measure
         v_lim       -- (vmin, vmax) lower and upper voltage measurement
                        boudaries
+        continuous  -- sample continuously instead of one finite
+                       acquisition per read
+        buffer_size -- size of the on-board buffer in continuous mode,
+                       defaults to one second of samples
+        backend     -- device driver, see get_backend()
         """
         # Logger
         self.logger = logging.getLogger("daqmx_channel.daqmx_channel_in")
 
+        if backend is None:
+            backend = get_backend()
+        self.backend = backend
         self._num_samples = num_samples
+        self.clockspeed = clockspeed
+        self.continuous = continuous
+        self._running = False
+        self._callback = None
+        if buffer_size is None:
+            buffer_size = max(int(clockspeed), 10 * num_samples)
+        self.buffer_size = buffer_size
         # Initialize an analog input channel for voltage measurement
-        self.taskHandle = TaskHandle(device * 8 + channel)
-        channel = 'Dev%i/ai%i' % (device, channel)
-
-        # Send commands to initialize an analog input channel
-        self.CHK(nidaq.DAQmxCreateTask("", ctypes.byref(self.taskHandle)))
-        self.CHK(nidaq.DAQmxCreateAIVoltageChan(self.taskHandle, channel,
-                                           "",
-                                           DAQmx_Val_diff,
-                                           float64(v_lim[0]),
-                                           float64(v_lim[1]),
-                                           DAQmx_Val_Volts, None))
-
-        self.CHK(nidaq.DAQmxCfgSampClkTiming(self.taskHandle, "",
-                                        float64(clockspeed),
-                                        DAQmx_Val_Rising,
-                                        DAQmx_Val_FiniteSamps,
-                                        uInt64(self._num_samples)))
+        if isinstance(channel, tuple):
+            channels = channel
+        else:
+            channels = (channel,)
+        self.num_channels = len(channels)
+        self.taskHandle = backend.create_ai_task(
+            device, channels, v_lim, clockspeed, continuous,
+            self.buffer_size if continuous else self._num_samples)
 
     def __enter__(self, *args, **kwargs):
         """for context manager"""
@@ -115,45 +306,176 @@ class daqmx_channel_in:
         self.cleanup()
         return value
 
-    def CHK(self, err):
-        """a simple error checking routine"""
-        if err < 0:
-            buf_size = 100
-            buf = ctypes.create_string_buffer('\000' * buf_size)
-            nidaq.DAQmxGetErrorString(err, ctypes.byref(buf), buf_size)
-            raise RuntimeError('nidaq call failed with error %d: %s' %
-                               (err, repr(buf.value)))
+    @property
+    def num_samples(self):
+        """Samples per channel of read_voltage(), and the minimum of
+        read_available()"""
+        return self._num_samples
+
+    def reconfigure(self, clockspeed=None, num_samples=None):
+        """Change the clock speed and the number of samples per read.
+
+        A running acquisition is stopped and starts again with the next
+        read, samples that were not read yet are lost. The buffer size
+        stays the same.
+        """
+        self.stop()
+        if clockspeed is not None:
+            self.clockspeed = clockspeed
+        if num_samples is not None:
+            self._num_samples = num_samples
+        self.backend.configure_timing(
+            self.taskHandle, self.clockspeed, self.continuous,
+            self.buffer_size if self.continuous else self._num_samples)
 
     def is_task_done(self):
-        result = bool32(False)
-        self.CHK(nidaq.DAQmxIsTaskDone(self.taskHandle, result))
-        return result
+        return self.backend.is_done(self.taskHandle)
 
     def wait_until_task_done(self, timeout=False):
         if not timeout:
             timeout = self.timeout
-        self.CHK(nidaq.DAQmxWaitUntilTaskDone(self.taskHandle,
-                 float64(timeout)))
+        self.backend.wait_until_done(self.taskHandle, timeout)
+
+    def start(self):
+        """Start the continuous acquisition"""
+        if not self._running:
+            self.backend.start(self.taskHandle)
+            self._running = True
+
+    def stop(self):
+        """Stop the continuous acquisition"""
+        if self._running:
+            self.backend.stop(self.taskHandle)
+            self._running = False
+
+    def samples_available(self):
+        """Return the number of acquired samples that were not read yet"""
+        return self.backend.samples_available(self.taskHandle)
+
+    def register_every_n_samples(self, callback):
+        """Call callback(self) every num_samples acquired samples.
+
+        Only in continuous mode, and before the task is started. The
+        callback runs in a driver thread and should read the samples with
+        read_voltage().
+        """
+        assert self.continuous and not self._running
+
+        def every_n_samples():
+            try:
+                callback(self)
+            except Exception:
+                self.logger.exception("Error in every N samples callback")
+            return 0
+        self._callback = self.backend.register_every_n_samples(
+            self.taskHandle, self._num_samples, every_n_samples)
+
+    def _read(self, num_samples, out=None):
+        size = num_samples * self.num_channels
+        if out is None:
+            data = numpy.zeros((size), dtype=numpy.float64)
+        else:
+            assert out.dtype == numpy.float64 and out.flags.c_contiguous
+            data = out.reshape(-1)[:size]
+            assert len(data) == size
+        self.backend.read(self.taskHandle, num_samples, data)
+        if self.grouped:
+            data = data.reshape(self.num_channels, num_samples)
+        return data
 
-    def read_voltage(self):
-        """Read an array of voltage data points from the channel"""
-        data = numpy.zeros((self._num_samples), dtype=numpy.float64)
+    def read_voltage(self, out=None):
+        """Read an array of voltage data points from the channel
+
+        arguments:
+        out -- optional float64 array of at least num_samples per channel to
+               read into, a view of its first elements is returned
+        """
         self.logger.debug("Start reading")
-        self.CHK(nidaq.DAQmxStartTask(self.taskHandle))
-        self.CHK(nidaq.DAQmxReadAnalogF64(self.taskHandle,
-                                        self._num_samples,
-                                        float64(10.0),
-                                        DAQmx_Val_GroupByChannel,
-                                        data.ctypes.data,
-                                        self._num_samples,
-                                        ctypes.byref(self.read), None))
-        nidaq.DAQmxStopTask(self.taskHandle)
+        start = monotonic()
+        if self.continuous:
+            self.start()
+            data = self._read(self._num_samples, out)
+        else:
+            self.backend.start(self.taskHandle)
+            data = self._read(self._num_samples, out)
+            self.backend.stop(self.taskHandle)
+        read_time.observe(monotonic() - start)
         self.logger.debug("End reading")
         return data
 
+    def read_available(self, out=None):
+        """Read all samples acquired since the last read, at least num_samples.
+
+        Continuous mode only. Blocks until num_samples are available. When
+        out is given, at most len(out) samples are read into it and a view
+        is returned.
+        """
+        assert self.continuous
+        start = monotonic()
+        self.start()
+        if out is None:
+            max_samples = self.buffer_size
+        else:
+            max_samples = out.size // self.num_channels
+        num_samples = min(max(self.samples_available(), self._num_samples),
+                          max_samples)
+        data = self._read(num_samples, out)
+        read_time.observe(monotonic() - start)
+        return data
+
     def cleanup(self):
         """Always cleanup, else DAQ hardware will lock"""
-        nidaq.DAQmxClearTask(self.taskHandle)
+        self.stop()
+        self.backend.clear(self.taskHandle)
+
+
+class daqmx_channel_group(daqmx_channel_in):
+    """Measure voltage on several channels in a single task
+
+    All channels are sampled by the same clock and read in one call, reads
+    return an array of shape (channels, samples). Buffers for out= need
+    num_channels * samples elements.
+
+    Example:
+    group = daqmx_channel_group(channels=(0, 1, 2), num_samples=100)
+    PID_output, error_signal, photodiode = group.read_voltage()
+    group.cleanup()
+    """
+
+    grouped = True
+
+    def __init__(self, device=1, channels=(0, 1, 2), **kwargs):
+        """ Initialize the channels to measure.
+
+        arguments:
+        channels -- channels to measure, other arguments as daqmx_channel_in
+        """
+        daqmx_channel_in.__init__(self, device=device,
+                                  channel=tuple(channels), **kwargs)
+        self.logger = logging.getLogger("daqmx_channel.daqmx_channel_group")
+
+
+class BufferPool:
+    """Round robin pool of preallocated sample buffers
+
+    Reading into buffers from the pool avoids allocating an array for every
+    read. A buffer returned by next() stays untouched for the following
+    count - 1 calls, so the previous blocks can still be used meanwhile.
+
+    Example:
+    pool = BufferPool(channel1.buffer_size)
+    data = channel1.read_available(out=pool.next())
+    """
+
+    def __init__(self, shape, count=4, dtype=numpy.float64):
+        self._buffers = [numpy.zeros(shape, dtype=dtype) for i in range(count)]
+        self._index = 0
+
+    def next(self):
+        """Return the next buffer of the pool"""
+        buf = self._buffers[self._index]
+        self._index = (self._index + 1) % len(self._buffers)
+        return buf
 
 
 class daqmx_digital_out():
@@ -170,20 +492,15 @@ class daqmx_digital_out():
     Warning: contains a bug. This will only work with port0 , and line 0, otherwise it won't.
     """
 
-    def __init__(self, device=1, port=0, line=0):
+    def __init__(self, device=1, port=0, line=0, backend=None):
         assert(port == 0)
         assert(line == 0)
-        addr = 'Dev%i/port%i/line0:7' % (device, port)
-        self.taskHandle = TaskHandle(device * 8 + port * 8 + line)
+        if backend is None:
+            backend = get_backend()
+        self.backend = backend
         # setup the DAQ hardware
-        self.CHK(nidaq.DAQmxCreateTask("",
-                          ctypes.byref(self.taskHandle)))
-        self.CHK(nidaq.DAQmxCreateDOChan(self.taskHandle,
-                                   addr,
-                                   "",
-                                   DAQmx_Val_ChanForAllLines
-                                   ))
-        self.CHK(nidaq.DAQmxStartTask(self.taskHandle))
+        self.taskHandle = backend.create_do_task(device, port)
+        backend.start(self.taskHandle)
 
     def __enter__(self, *args, **kwargs):
         """for context manager"""
@@ -194,32 +511,9 @@ class daqmx_digital_out():
         self.cleanup()
         return value
 
-    def CHK(self, err):
-        """a simple error checking routine"""
-        if err < 0:
-            buf_size = 1000
-            buf = ctypes.create_string_buffer('\000' * buf_size)
-            nidaq.DAQmxGetErrorString(err, ctypes.byref(buf), buf_size)
-            raise RuntimeError('nidaq call failed with error %d: %s' % (err,
-                                        repr(buf.value)))
-        if err > 0:
-            buf_size = 1000
-            buf = ctypes.create_string_buffer('\000' * buf_size)
-            nidaq.DAQmxGetErrorString(err, ctypes.byref(buf), buf_size)
-            raise RuntimeError('nidaq generated warning %d: %s' % (err,
-                                            repr(buf.value)))
-
     def set_on(self, off=False):
         data = numpy.array(8*[not off]).astype(numpy.uint32)
-        written = numpy.zeros_like(data)
-        self.CHK(nidaq.DAQmxWriteDigitalU32(self.taskHandle,
-                        1,  # numSampsPerCHan
-                        int32(1),  # autoStart
-                        float64(10.0),  # timeout
-                        DAQmx_Val_GroupByChannel,  # dataLayout
-                        data.ctypes.data,  # writeArray
-                        written.ctypes.data,  # writeArray
-                        None))
+        self.backend.write_digital(self.taskHandle, data)
 
     def set_off(self):
         self.set_on(off=True)
@@ -227,8 +521,8 @@ class daqmx_digital_out():
     def cleanup(self):
         """Always cleanup, else DAQ hardware will lock"""
         self.set_off()
-        nidaq.DAQmxStopTask(self.taskHandle)
-        nidaq.DAQmxClearTask(self.taskHandle)
+        self.backend.stop(self.taskHandle)
+        self.backend.clear(self.taskHandle)
 
 if __name__ == '__main__':
     import time
@@ -238,15 +532,15 @@ if __name__ == '__main__':
     print "TTL created"
     ttl.set_on()
 
-    # listen to 3 channels
+    # listen to 3 channels in one task
     nr_samples = 100
-    channel1 = daqmx_channel_in(device=1, channel=0, num_samples=nr_samples)
-    channel2 = daqmx_channel_in(device=1, channel=1, num_samples=nr_samples)
-    channel3 = daqmx_channel_in(device=1, channel=2, num_samples=nr_samples)
+    channels = daqmx_channel_group(device=1, channels=(0, 1, 2),
+                                   num_samples=nr_samples)
     while True:
-        print "Channel1 sum %.3f V" % channel1.read_voltage().sum() 
-        print "Channel2 mean %.3f V" % channel2.read_voltage().mean()
-        print "Channel3 std: %.3f V" % channel3.read_voltage().std()
+        data1, data2, data3 = channels.read_voltage()
+        print "Channel1 sum %.3f V" % data1.sum()
+        print "Channel2 mean %.3f V" % data2.mean()
+        print "Channel3 std: %.3f V" % data3.std()
         time.sleep(1)
 #    # read channel1
 #    import matplotlib
@@ -295,10 +589,8 @@ if __name__ == '__main__':
 #    plt.show()
 
     print (time.time() - start) / 100.0
-    print "Acquired %d points" % channel1.read.value
-    channel1.cleanup()
-    channel2.cleanup()
-    channel3.cleanup()
+    print "Acquired %d points" % channels.backend.samples_read.value
+    channels.cleanup()
 
 #channel1 = None
 
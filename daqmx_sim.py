@@ -0,0 +1,322 @@
+""" Simulated NI-DAQ device, a backend for the channels of daqmx_channel.
+
+Every analog input of the simulated device is the PID output of the lock box
+of a laser, see SimulatedLaser. The samples are generated with numpy when
+they are read, so the feedback loop can run without hardware, also at
+sample rates far above those of a USB-6009.
+
+Example:
+from daqmx_channel import daqmx_channel_in
+from daqmx_sim import SimulatedDAQ
+daq = SimulatedDAQ()
+channel = daqmx_channel_in(num_samples=100, continuous=True, backend=daq)
+daq.laser(channel=0).set_temperature = 17.8
+data = channel.read_available()
+"""
+import math
+import threading
+import time
+import numpy as np
+from scheduler import monotonic
+
+LOCKED = 'locked'
+UNLOCKED = 'unlocked'
+OUT_OF_LOCK = 'out_of_lock'
+
+
+class SimulatedLaser(object):
+    """ PID output of a laser locked to a reference.
+
+    While locked the output follows the laser temperature: it is
+    offset + gain * (temperature - reference_temperature) with a little
+    noise. The laser temperature relaxes to the set temperature of the
+    chiller with time_constant, plus a slow sinusoidal drift of the lab.
+    When the output runs into the rails the lock is lost; the output then
+    jumps around and the lock is found again after relock_time if the
+    output is back between the rails. Unlocked, the lock box holds its
+    output at unlocked_level.
+
+    The states give the std over a few samples that the LockDetector with
+    its default thresholds expects: locked between not_locking_std and
+    out_of_lock_std, unlocked below and out of lock above.
+    """
+
+    gain = 2.0  # V per degree of the laser temperature
+    offset = 3.1  # V at the reference temperature
+    reference_temperature = 17.7  # degree
+    time_constant = 120.  # s, response of the laser to the chiller
+    drift_amplitude = 0.2  # degree, drift of the lab temperature
+    drift_period = 3600.  # s
+    rails = (0., 10.)  # V, output range of the lock box
+    relock_time = 5.  # s
+    locked_noise = 0.02  # V std
+    unlocked_noise = 0.001  # V std
+    unlocked_level = 0.  # V
+    out_of_lock_noise = 1.  # V std
+    noise_samples = 2 ** 16  # length of the table the noise is taken from
+
+    def __init__(self, seed=None, **settings):
+        for key, value in settings.items():
+            if not hasattr(SimulatedLaser, key):
+                raise TypeError('Unknown setting %s' % key)
+            setattr(self, key, value)
+        self.random = np.random.RandomState(seed)
+        # slices of a table of gaussian noise, at random offsets, are
+        # cheaper than new random numbers for every sample
+        self._noise = self.random.standard_normal(self.noise_samples)
+        self._ramp = np.arange(0.)
+        self.set_temperature = self.reference_temperature
+        self.temperature = self.reference_temperature
+        self._source = None
+        self._state = LOCKED
+        self._lost_at = None  # time the lock was lost by running into a rail
+        self._time = None  # time of the end of the last generated block
+
+    @property
+    def state(self):
+        """ LOCKED, UNLOCKED or OUT_OF_LOCK """
+        return self._state
+
+    @state.setter
+    def state(self, state):
+        assert state in (LOCKED, UNLOCKED, OUT_OF_LOCK)
+        self._state = state
+        self._lost_at = None
+
+    def follow(self, source):
+        """ Take the set temperature from source(), e.g.
+        cooler.lastSetTemperature, at every block. None is ignored """
+        self._source = source
+
+    def output(self, temperature):
+        """ PID output while locked at laser temperature """
+        return self.offset + self.gain * (temperature -
+                                          self.reference_temperature)
+
+    def _lab_drift(self, t):
+        return self.drift_amplitude * math.sin(2 * math.pi * t /
+                                               self.drift_period)
+
+    def generate(self, t, dt, out):
+        """ Fill out with the samples from time t on, dt apart """
+        n = len(out)
+        if self._source is not None:
+            set_temperature = self._source()
+            if set_temperature is not None:
+                self.set_temperature = set_temperature
+        if self._time is None:
+            self._time = t
+        # relax the laser temperature over the block
+        duration = max(t + n * dt - self._time, 0.)
+        self._time = t + n * dt
+        start = self.output(self.temperature)
+        target = self.set_temperature + self._lab_drift(self._time)
+        self.temperature += (target - self.temperature) * \
+            (1 - math.exp(-duration / self.time_constant))
+        stop = self.output(self.temperature)
+
+        if self._state == LOCKED and not \
+                self.rails[0] <= stop <= self.rails[1]:
+            self._state = OUT_OF_LOCK
+            self._lost_at = t
+        elif self._state == OUT_OF_LOCK and self._lost_at is not None and \
+                t - self._lost_at > self.relock_time and \
+                self.rails[0] <= stop <= self.rails[1]:
+            self._state = LOCKED
+            self._lost_at = None
+
+        if self._state == LOCKED:
+            if len(self._ramp) < n:
+                self._ramp = np.arange(float(n))
+            np.multiply(self._ramp[:n], (stop - start) / n, out=out)
+            out += start
+            noise = self.locked_noise
+        elif self._state == UNLOCKED:
+            out[:] = self.unlocked_level
+            noise = self.unlocked_noise
+        else:
+            out[:] = 0.5 * (self.rails[0] + self.rails[1])
+            noise = self.out_of_lock_noise
+        self._add_noise(out, noise)
+        np.clip(out, self.rails[0], self.rails[1], out=out)
+
+    def _add_noise(self, out, scale):
+        table = self._noise
+        done = 0
+        while done < len(out):
+            n = min(len(out) - done, len(table))
+            offset = self.random.randint(0, len(table) - n + 1)
+            chunk = out[done:done + n]
+            chunk += scale * table[offset:offset + n]
+            done += n
+
+
+class _AITask:
+    def __init__(self, device, channels, clockspeed, continuous,
+                 num_samples):
+        self.device = device
+        self.channels = channels
+        self.clockspeed = clockspeed
+        self.continuous = continuous
+        self.num_samples = num_samples  # buffer size if continuous
+        self.running = False
+        self.start_time = 0.
+        self.position = 0  # samples per channel read since the start
+        self.callback = None
+
+
+class _DOTask:
+    def __init__(self, device, port):
+        self.device = device
+        self.port = port
+        self.lines = np.zeros(8, dtype=np.uint32)
+
+
+class SimulatedDAQ:
+    """ Backend for daqmx_channel_in and daqmx_digital_out without hardware.
+
+    Channel c of device d reads the PID output of laser(d, c). In realtime
+    mode samples become available at the clock speed of the task, like on
+    the hardware, and reads block until they are. Otherwise every read
+    returns at once and advances the simulated time by the samples read,
+    which runs the loop as fast as the computer allows. block_size is the
+    number of samples reported available in that mode; 0 makes
+    read_available() return num_samples per read.
+
+    A continuous task that is not read for longer than its buffer lasts
+    drops the oldest samples, overflows counts them.
+    """
+
+    def __init__(self, realtime=True, block_size=0, seed=None,
+                 clock=monotonic):
+        self.realtime = realtime
+        self.block_size = block_size
+        self.seed = seed
+        self.clock = clock
+        self.lasers = {}
+        self.overflows = 0
+
+    def laser(self, device=1, channel=0):
+        """ Return the laser on channel of device, created on first use """
+        key = (device, channel)
+        if key not in self.lasers:
+            seed = None if self.seed is None else self.seed + len(self.lasers)
+            self.lasers[key] = SimulatedLaser(seed=seed)
+        return self.lasers[key]
+
+    def create_ai_task(self, device, channels, v_lim, clockspeed, continuous,
+                       num_samples):
+        for channel in channels:
+            self.laser(device, channel)
+        return _AITask(device, tuple(channels), clockspeed, continuous,
+                       num_samples)
+
+    def create_do_task(self, device, port):
+        return _DOTask(device, port)
+
+    def configure_timing(self, task, clockspeed, continuous, num_samples):
+        task.clockspeed = clockspeed
+        task.continuous = continuous
+        task.num_samples = num_samples
+
+    def start(self, task):
+        if isinstance(task, _DOTask):
+            return
+        task.running = True
+        task.start_time = self.clock()
+        task.position = 0
+        if task.callback is not None:
+            thread = threading.Thread(target=self._every_n_samples,
+                                      args=(task,), name='simulated DAQ')
+            thread.setDaemon(True)
+            thread.start()
+
+    def stop(self, task):
+        task.running = False
+
+    def clear(self, task):
+        task.running = False
+
+    def is_done(self, task):
+        return not task.running or (not task.continuous and
+                                    task.position >= task.num_samples)
+
+    def wait_until_done(self, task, timeout):
+        pass
+
+    def _acquired(self, task):
+        """ Samples per channel acquired since the start """
+        return int((self.clock() - task.start_time) * task.clockspeed)
+
+    def samples_available(self, task):
+        if not self.realtime:
+            return self.block_size
+        available = self._acquired(task) - task.position
+        if task.continuous and available > task.num_samples:
+            # the buffer overflowed, the oldest samples are lost
+            self.overflows += available - task.num_samples
+            task.position += available - task.num_samples
+            available = task.num_samples
+        return available
+
+    def read(self, task, num_samples, data):
+        if self.realtime:
+            missing = task.position + num_samples - self._acquired(task)
+            if missing > 0:
+                time.sleep(float(missing) / task.clockspeed)
+        dt = 1. / task.clockspeed
+        t = task.start_time + task.position * dt
+        for i, channel in enumerate(task.channels):
+            self.lasers[task.device, channel].generate(
+                t, dt, data[i * num_samples:(i + 1) * num_samples])
+        task.position += num_samples
+
+    def register_every_n_samples(self, task, num_samples, callback):
+        task.callback = (num_samples, callback)
+        return task.callback
+
+    def _every_n_samples(self, task):
+        num_samples, callback = task.callback
+        called = 0
+        while task.running:
+            if self.realtime:
+                missing = (called + 1) * num_samples - self._acquired(task)
+                if missing > 0:
+                    time.sleep(float(missing) / task.clockspeed)
+                    if not task.running:
+                        break
+            called += 1
+            callback()
+
+    def write_digital(self, task, data):
+        task.lines[:] = data
+
+
+if __name__ == '__main__':
+    from daqmx_channel import daqmx_channel_in
+    from lockdetector import LockDetector
+
+    # a minute of simulated time at 1 MS/s, as fast as it computes
+    daq = SimulatedDAQ(realtime=False, block_size=100000, seed=0)
+    channel = daqmx_channel_in(clockspeed=1e6, num_samples=10,
+                               continuous=True, buffer_size=100000,
+                               backend=daq)
+    laser = daq.laser()
+    detector = LockDetector()
+    start = time.time()
+    for i in range(600):
+        if i == 200:
+            laser.state = UNLOCKED
+        elif i == 300:
+            laser.state = OUT_OF_LOCK
+        elif i == 400:
+            laser.state = LOCKED
+            laser.set_temperature = 18.2
+        block = channel.read_available()
+        state = detector.update(block)
+        if i % 50 == 0:
+            print "%5.1f s  %-11s  %.3f V  lock state %s" % (
+                i * 0.1, laser.state, block.mean(), state)
+    elapsed = time.time() - start
+    print "%.1f MS/s" % (600 * 1e5 / elapsed / 1e6)
+    channel.cleanup()
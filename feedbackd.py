@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+""" Run the temperature feedback without a GUI, e.g. as a service.
+
+Only the control path is imported: no GTK or Matplotlib, and the NI-DAQmx
+driver is loaded when the first task is created. The first loop iteration
+runs as soon as the devices are connected.
+
+Usage:
+    python feedbackd.py                      # single loop, as gui.py
+    python feedbackd.py --config Regulators.ini
+    python feedbackd.py --metrics-port 9100 --heartbeat feedbackd.alive
+    python feedbackd.py --telemetry-port 9200
+
+With --heartbeat the file is touched every second while the loop runs, so a
+watchdog can restart the service when it stops updating.
+"""
+import argparse
+import logging
+import os
+import signal
+import sys
+
+
+def touch(path):
+    with open(path, 'a'):
+        os.utime(path, None)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Headless temperature '
+                                                 'feedback loop')
+    parser.add_argument('--config', help='run a loop for every laser in this '
+                        'ini file, see supervisor.py')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='serve metrics on http://127.0.0.1:PORT/metrics')
+    parser.add_argument('--telemetry-port', type=int, default=None,
+                        help='stream the loops on 127.0.0.1:PORT, see '
+                        'telemetryserver.py')
+    parser.add_argument('--heartbeat', help='file to touch every second')
+    parser.add_argument('--inactive', action='store_true',
+                        help='start without performing feedback')
+    args = parser.parse_args(argv)
+
+    logging.getLogger().setLevel(logging.INFO)
+
+    if args.config:
+        from supervisor import Supervisor
+        runner = Supervisor(args.config, metrics_port=args.metrics_port,
+                            telemetry_port=args.telemetry_port)
+        loops = runner.loops
+    else:
+        from temperatureFeedback import feedbackLoop
+        runner = feedbackLoop(metrics_port=args.metrics_port,
+                              telemetry_port=args.telemetry_port)
+        loops = [runner]
+    for loop in loops:
+        loop.active = not args.inactive
+
+    scheduler = runner.scheduler
+    if args.heartbeat:
+        scheduler.add('heartbeat', 1., lambda: touch(args.heartbeat))
+
+    def stop(signum, frame):
+        scheduler.stop()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    try:
+        scheduler.run()
+    finally:
+        if runner.telemetry is not None:
+            runner.telemetry.shutdown()
+        for loop in loops:
+            for archive in (loop.archive, loop.raw_archive):
+                if archive is not None:
+                    archive.flush()
+            if loop.capture is not None:
+                loop.capture.close()
+            loop.cooler.close()
+        if args.config:
+            runner.cleanup()
+        else:
+            runner.PID_output.cleanup()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,71 @@
+import ctypes
+import multiprocessing
+from history import History
+from temperatureFeedback import feedbackLoop, LoopState, history_columns_for
+
+
+def _run_feedback_loop(columns, length, history_buffer, state, psd_bands):
+    """ Entry point of the feedback process """
+    loop = feedbackLoop(history=History(columns, length,
+                                        buffer=history_buffer),
+                        state=state, psd_bands=psd_bands)
+    loop.run()
+
+
+class FeedbackProcess(object):
+    """ Run a feedbackLoop in its own process.
+
+    The histories and the loop state live in shared memory. This process
+    maps the histories read-only and can use the object like a feedbackLoop
+    thread: start(), active, lock_state, history, signal_history,
+    time_history, min_signal, max_signal and psd_bands. Load in this process
+    (GUI redraws, garbage collection) can no longer delay the control loop.
+
+    Example:
+    loop = FeedbackProcess()
+    loop.start()
+    loop.active = True
+    """
+
+    min_signal = feedbackLoop.min_signal
+    max_signal = feedbackLoop.max_signal
+    length_signals = feedbackLoop.length_signals
+    psd_bands = feedbackLoop.psd_bands
+
+    def __init__(self):
+        self.history_columns = history_columns_for(self.psd_bands)
+        nbytes = History.nbytes(self.history_columns, self.length_signals)
+        history_buffer = multiprocessing.RawArray(ctypes.c_byte, nbytes)
+        self.state = LoopState(
+            active=multiprocessing.RawValue(ctypes.c_bool, True),
+            lock_state=multiprocessing.RawValue(ctypes.c_int, -1))
+
+        self.history = History(self.history_columns, self.length_signals,
+                               buffer=history_buffer, readonly=True)
+        self.signal_history = self.history['signal']
+        self.time_history = self.history['time']
+
+        self.process = multiprocessing.Process(
+            target=_run_feedback_loop,
+            args=(self.history_columns, self.length_signals,
+                  history_buffer, self.state, self.psd_bands))
+        self.process.daemon = True
+
+    def start(self):
+        self.process.start()
+
+    def stop(self):
+        self.process.terminate()
+        self.process.join()
+
+    def _get_active(self):
+        return self.state.active
+
+    def _set_active(self, value):
+        self.state.active = value
+
+    active = property(_get_active, _set_active)
+
+    @property
+    def lock_state(self):
+        return self.state.lock_state
@@ -6,16 +6,26 @@ import matplotlib
 matplotlib.use('gtkAgg')
 from matplotlib.figure import Figure
 from temperatureFeedback import feedbackLoop
+from feedbackprocess import FeedbackProcess
+from lod import MinMaxPyramid
 from matplotlib.backends.backend_gtkagg import FigureCanvasGTKAgg as FigureCanvas
 import sys
 
 class FeedbackApp:
 
-    def __init__(self):
+    max_fps = 10 # maximum number of redraws per second
+    time_headroom = 0.2 # fraction of the time axis kept free on the right
+
+    def __init__(self, use_process=False):
+        """ Create the window and start the feedback loop, in a separate
+        process if use_process is set """
         # initialize the feedbackloop
         gtk.threads_init()
         gtk.threads_enter()
-        self.feedbackloop = feedbackLoop()
+        if use_process:
+            self.feedbackloop = FeedbackProcess()
+        else:
+            self.feedbackloop = feedbackLoop()
         self.feedbackloop.active = False
         self.feedbackloop.start()
         gtk.threads_leave()
@@ -38,7 +48,16 @@ class FeedbackApp:
         self.axes = self.figure.add_subplot(111)
         self.axes.grid()
 
-        self.line, = self.axes.plot([1,2,3,4,5],[5,3,5,2,5],'-^', label='output signal PID')
+        # the data line is animated: it is left out of full redraws and
+        # blitted on top of the cached background instead
+        self.line, = self.axes.plot([1,2,3,4,5],[5,3,5,2,5],'-^', label='output signal PID', animated=True)
+        self.axes.set_ylim(0,5)
+        self.background = None
+        self._last_count = -1
+        # decimated copy of the whole signal history, the plot only gets
+        # about one min/max pair per pixel
+        self.pyramid = MinMaxPyramid()
+        self.figureCanvas.mpl_connect('draw_event', self.on_draw)
 
         # topline
         self.topline, = self.axes.plot([-1e99, 1e99], 2*[self.feedbackloop.max_signal], label='upper lim')
@@ -47,6 +66,10 @@ class FeedbackApp:
         self.axes.legend(loc=2)
 
 
+        # power of the PID output per band of its spectrum
+        self.bandLabel = gtk.Label('')
+        self.vbox.pack_start(self.bandLabel, expand=False, fill=True)
+
         # button start/stop
         self.buttonBox = gtk.HButtonBox()
         self.vbox.pack_end(self.buttonBox, expand=False, fill=True)
@@ -57,7 +80,7 @@ class FeedbackApp:
 
 
         self.win.show_all()
-        gobject.idle_add(self.update_graph)
+        gobject.timeout_add(int(1000 / self.max_fps), self.update_graph)
 
     def activateFeedbackLoop(self, *args):
         """ Activate the feedbackloop """
@@ -72,25 +95,48 @@ class FeedbackApp:
     # add a start/stop box
 
 
+    def on_draw(self, event):
+        """ Cache the background after a full redraw """
+        self.background = self.figureCanvas.copy_from_bbox(self.axes.bbox)
+        self.axes.draw_artist(self.line)
+
     def update_graph(self):
         """ Update the graphical representation of the feedback loop"""
-        xdata = self.feedbackloop.time_history.toArray()
-        order = np.argsort(xdata)
-        xdata = xdata[order]
-        ydata = self.feedbackloop.signal_history.toArray()
-        ydata = ydata[order]
-
-        self.line.set_xdata(xdata)
-        self.line.set_ydata(ydata)
-        self.figureCanvas.draw()
-        try:
-            if not (None in xdata.tolist()):
-                self.axes.set_xlim(min(xdata),max(xdata))
-            else:
-                self.axes.set_xlim(max(xdata)-20, max(xdata))
-            self.axes.set_ylim(0,5)
-        except:
-            pass
+        history = self.feedbackloop.history
+        if history.count == self._last_count:
+            # no new samples
+            return True
+
+        # feed the new samples to the pyramid, the snapshot never has a
+        # time without its signal
+        count, data = history.snapshot(since=self._last_count)
+        self._last_count = count
+        if not len(data['time']):
+            return True
+        self.pyramid.extend(data['time'], data['signal'])
+        self.bandLabel.set_text('   '.join(
+            ['%g-%g Hz: %.2e V^2' % (low, high, data['band%i' % i][-1])
+             for i, (low, high) in enumerate(self.feedbackloop.psd_bands)]))
+        start, stop = self.pyramid.first_time(), self.pyramid.last_time()
+
+        # only rescale the time axis, and redraw everything, when the data
+        # runs out of the axis
+        xmin, xmax = self.axes.get_xlim()
+        redraw = self.background is None or stop > xmax
+        if redraw:
+            span = max(stop - start, 20.)
+            xmin, xmax = start, start + span*(1 + self.time_headroom)
+            self.axes.set_xlim(xmin, xmax)
+        xdata, ydata = self.pyramid.envelope(xmin, xmax,
+                                             int(self.axes.bbox.width))
+        self.line.set_data(xdata, ydata)
+
+        if redraw:
+            self.figureCanvas.draw()
+        else:
+            self.figureCanvas.restore_region(self.background)
+            self.axes.draw_artist(self.line)
+            self.figureCanvas.blit(self.axes.bbox)
 
         return True
 
@@ -98,7 +144,8 @@ class FeedbackApp:
 
 
 if __name__ == '__main__':
-    FeedbackApp()
+    # gui.py --process runs the feedback loop in its own process
+    FeedbackApp(use_process='--process' in sys.argv)
 
     # start
 
@@ -0,0 +1,182 @@
+import time
+import numpy as np
+
+
+class CircularArray:
+    """ Fixed length float64 ring buffer.
+
+    Samples are written twice, at i and i + length, so that the last
+    `length` samples are always available as one contiguous slice. This
+    makes append O(1) and gives a chronologically ordered view without
+    sorting or copying.
+
+    The only state besides the samples is the number of appended samples,
+    so the array can live in shared memory: pass a buffer of
+    CircularArray.nbytes(length) bytes, e.g. a multiprocessing.RawArray,
+    and map the same buffer with readonly=True in the other process.
+    """
+    def __init__(self, length, buffer=None, readonly=False):
+        """" Create a circular array of length length """
+        self.length = int(length)
+
+        if buffer is None:
+            buffer = bytearray(self.nbytes(self.length))
+        # number of samples appended since creation, followed by the samples
+        self._count = np.frombuffer(buffer, dtype=np.int64, count=1)
+        self._array = np.frombuffer(buffer, dtype=np.float64,
+                                    count=2*self.length, offset=8)
+        if readonly:
+            self._count.flags.writeable = False
+            self._array.flags.writeable = False
+
+    @staticmethod
+    def nbytes(length):
+        """ Size in bytes of the buffer of a CircularArray of length length """
+        return 8 + 16*int(length)
+
+    @property
+    def count(self):
+        """ Number of samples appended since creation """
+        return int(self._count[0])
+
+    def append(self, item):
+        """ Add item, overwriting the oldest sample when full """
+        count = int(self._count[0])
+        index = count % self.length
+        self._array[index] = item
+        self._array[index + self.length] = item
+        # publish the sample after it is written
+        self._count[0] = count + 1
+
+    def _range(self, count):
+        fill = min(count, self.length)
+        head = (count - fill) % self.length
+        return head, fill
+
+    def __len__(self):
+        return min(self.count, self.length)
+
+    def __getitem__(self, key):
+        """ Chronological indexing, -1 is the most recent sample """
+        return self.toArray()[key]
+
+    def toArray(self):
+        """ Return a read-only chronological view of the samples.
+
+        The view is not a copy, it changes as new samples are appended.
+        """
+        head, fill = self._range(self.count)
+        view = self._array[head:head + fill]
+        view.flags.writeable = False
+        return view
+
+    def last(self, n):
+        """ Return a view of the n most recent samples """
+        data = self.toArray()
+        n = min(int(n), len(data))
+        if n <= 0:
+            return data[:0]
+        return data[len(data) - n:]
+
+    def window(self, start, stop=None):
+        """ Return the slice of the samples within [start, stop].
+
+        Only meaningful for non-decreasing data like timestamps, the slice
+        can be applied to the toArray() of an array filled in lockstep.
+        """
+        data = self.toArray()
+        first = np.searchsorted(data, start, side='left')
+        if stop is None:
+            last = len(data)
+        else:
+            last = np.searchsorted(data, stop, side='right')
+        return slice(first, last)
+
+    def __str__(self):
+        return self.toArray().__str__()
+
+
+class History:
+    """ Named CircularArrays of equal length that are appended to together.
+
+    A sequence counter in front of the columns gives readers consistent
+    snapshots without locks: the writer makes the counter odd before and
+    even after every append, and snapshot() copies the columns and retries
+    when the counter was odd or changed meanwhile. The writer never waits,
+    so any number of readers can attach without affecting the loop timing.
+
+    Like a CircularArray the history can live in shared memory: pass a
+    buffer of History.nbytes(columns, length) bytes.
+
+    Example:
+    history = History(('time', 'signal'), 200)
+    history.append(time.time(), 3.1)
+    count, data = history.snapshot()
+    plot(data['time'], data['signal'])
+    """
+    def __init__(self, columns, length, buffer=None, readonly=False):
+        self.columns = tuple(columns)
+        self.length = int(length)
+        if buffer is None:
+            buffer = bytearray(self.nbytes(self.columns, self.length))
+        data = np.frombuffer(buffer, dtype=np.uint8)
+        # number of appends started plus finished, then the columns
+        self._sequence = data[:8].view(np.int64)
+        size = CircularArray.nbytes(self.length)
+        self._arrays = {}
+        for i, name in enumerate(self.columns):
+            start = 8 + i * size
+            self._arrays[name] = CircularArray(self.length,
+                                               buffer=data[start:start + size],
+                                               readonly=readonly)
+        self._ordered = [self._arrays[name] for name in self.columns]
+        if readonly:
+            self._sequence.flags.writeable = False
+
+    @staticmethod
+    def nbytes(columns, length):
+        """ Size in bytes of the buffer of a History """
+        return 8 + len(columns) * CircularArray.nbytes(length)
+
+    def __getitem__(self, name):
+        """ Return the CircularArray of a column, for the writer or for
+        reads that do not have to be consistent with other columns """
+        return self._arrays[name]
+
+    @property
+    def count(self):
+        """ Number of appends since creation """
+        return self._ordered[0].count
+
+    def __len__(self):
+        return min(self.count, self.length)
+
+    def append(self, *values):
+        """ Append a value to every column, in the order of the columns """
+        assert len(values) == len(self.columns), 'One value per column'
+        sequence = int(self._sequence[0])
+        self._sequence[0] = sequence + 1
+        for array, value in zip(self._ordered, values):
+            array.append(value)
+        self._sequence[0] = sequence + 2
+
+    def snapshot(self, since=None):
+        """ Return (count, dict of copies of every column), all between the
+        same two appends.
+
+        arguments:
+        since -- only return the samples appended after count was since,
+                 as far as they are still in the history
+        """
+        while True:
+            sequence = int(self._sequence[0])
+            if sequence % 2:
+                # an append is in progress, let the writer finish
+                time.sleep(0)
+                continue
+            count = self.count
+            n = min(count - max(since or 0, 0), self.length)
+            data = dict((name, np.array(self._arrays[name].last(n)))
+                        for name in self.columns)
+            if int(self._sequence[0]) == sequence:
+                return count, data
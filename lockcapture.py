@@ -0,0 +1,199 @@
+import os
+import time
+import logging
+import threading
+import Queue
+import numpy as np
+from metrics import registry
+
+captures = registry.counter('lock_loss_captures_total',
+                            'Lock transitions captured with raw samples')
+dropped = registry.counter('lock_loss_captures_dropped_total',
+                           'Lock transitions not captured, no free buffer')
+
+
+class _Event:
+    """ Preallocated buffer of one capture """
+    def __init__(self, size):
+        self.samples = np.zeros(size, dtype=np.float64)
+        self.count = 0
+        self.time = 0.
+        self.trigger_index = 0
+        self.sample_rate = None
+        self.post_remaining = 0.  # s of samples still to collect
+        self.segments = []  # (index of the first sample, sample rate)
+        self.from_state = None
+        self.to_state = None
+
+
+class LockLossCapture:
+    """ Record the raw samples around lock transitions.
+
+    The samples of the last pre_time seconds are kept in a ring buffer. On
+    trigger() they are copied to a free event buffer, which is then filled
+    with the samples of the next post_time seconds and written to directory
+    by a background thread. All buffers are allocated up front for
+    max_sample_rate; when all `slots` buffers are still being filled or
+    written a transition is dropped instead of waiting.
+
+    The sample rate may change while a capture collects, e.g. when the
+    acquisition turns dense after a lock loss: the rest of the post window
+    is then collected at the new rate, and the capture records the index at
+    which every rate starts.
+
+    Every capture is a file lockloss_<time>.npz with the samples, the index
+    of the first sample after the trigger, the sample rate at the trigger,
+    rate_indices and sample_rates of every rate segment, the time of the
+    trigger and the lock states before and after.
+
+    Example:
+    capture = LockLossCapture('lock_losses', 1., 1., sample_rate=1e4)
+    capture.add(block)  # every acquired block
+    capture.trigger(time.time(), 1, 2)  # on a lock loss
+    """
+
+    def __init__(self, directory, pre_time, post_time, sample_rate,
+                 max_sample_rate=None, slots=4, states=(2,)):
+        """
+        arguments:
+        pre_time, post_time -- s of samples kept before and after a trigger
+        max_sample_rate     -- highest sample rate the buffers have to hold,
+                               default sample_rate
+        slots               -- number of event buffers
+        states              -- lock states that trigger a capture when
+                               entered
+        """
+        self.directory = directory
+        self.pre_time = pre_time
+        self.post_time = post_time
+        if max_sample_rate is None:
+            max_sample_rate = sample_rate
+        max_sample_rate = max(max_sample_rate, sample_rate)
+        self.pre_samples = int(round(pre_time * max_sample_rate))
+        self.post_samples = int(round(post_time * max_sample_rate))
+        self.sample_rate = sample_rate
+        self.states = states
+        self.logger = logging.getLogger('lockcapture')
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # mirrored ring, the last pre_samples samples are always contiguous
+        # at [position:position + pre_samples]
+        self._ring = np.zeros(2 * self.pre_samples, dtype=np.float64)
+        self._position = 0
+        self._filled = 0
+
+        self._free = Queue.Queue()
+        for slot in range(slots):
+            self._free.put(_Event(self.pre_samples + self.post_samples))
+        self._pending = Queue.Queue()
+        self._active = []  # events waiting for post-trigger samples
+        self._writer = threading.Thread(target=self._write,
+                                        name='lock loss writer')
+        self._writer.setDaemon(True)
+        self._writer.start()
+
+    def add(self, block):
+        """ Add the samples of an acquired block """
+        if self._active:
+            for event in list(self._active):
+                wanted = int(round(event.post_remaining * self.sample_rate))
+                n = min(len(block), len(event.samples) - event.count, wanted)
+                event.samples[event.count:event.count + n] = block[:n]
+                event.count += n
+                event.post_remaining -= n / float(self.sample_rate)
+                if n == wanted or event.count == len(event.samples):
+                    self._active.remove(event)
+                    self._pending.put(event)
+
+        pre = self.pre_samples
+        if pre == 0:
+            return
+        if len(block) > pre:
+            block = block[-pre:]
+        n = len(block)
+        first = min(n, pre - self._position)
+        for offset in (0, pre):
+            start = self._position + offset
+            self._ring[start:start + first] = block[:first]
+            self._ring[offset:offset + n - first] = block[first:]
+        self._position = (self._position + n) % pre
+        self._filled = min(self._filled + n, pre)
+
+    @property
+    def collecting(self):
+        """ True while a capture waits for samples after its trigger """
+        return bool(self._active)
+
+    def set_sample_rate(self, sample_rate):
+        """ Change the sample rate of the next samples. Collecting captures
+        continue at the new rate; the samples of the ring were taken at the
+        old rate, they are forgotten """
+        self.sample_rate = sample_rate
+        self._filled = 0
+        for event in self._active:
+            event.segments.append((event.count, sample_rate))
+
+    def trigger(self, time, from_state, to_state):
+        """ Start a capture if to_state is one of the trigger states """
+        if to_state not in self.states:
+            return
+        try:
+            event = self._free.get_nowait()
+        except Queue.Empty:
+            dropped.inc()
+            self.logger.warning('No free buffer, lock transition not '
+                                'captured')
+            return
+        captures.inc()
+        pre = int(round(self.pre_time * self.sample_rate))
+        pre = min(pre, self.pre_samples)
+        filled = min(self._filled, pre)
+        # samples from before the start are not known
+        event.samples[:pre - filled] = np.nan
+        end = self._position + self.pre_samples
+        event.samples[pre - filled:pre] = self._ring[end - filled:end]
+        event.count = pre
+        event.trigger_index = pre
+        event.time = time
+        event.sample_rate = self.sample_rate
+        event.post_remaining = self.post_time
+        event.segments = [(0, self.sample_rate)]
+        event.from_state = from_state
+        event.to_state = to_state
+        if self.post_time > 0:
+            self._active.append(event)
+        else:
+            self._pending.put(event)
+
+    def _write(self):
+        while True:
+            event = self._pending.get()
+            if event is None:
+                return
+            stamp = time.strftime('%Y%m%d_%H%M%S',
+                                  time.localtime(event.time))
+            path = os.path.join(self.directory, 'lockloss_%s_%03i.npz' % (
+                stamp, int(event.time * 1000) % 1000))
+            try:
+                indices, rates = zip(*event.segments)
+                np.savez(path, samples=event.samples[:event.count],
+                         trigger_index=event.trigger_index,
+                         sample_rate=event.sample_rate,
+                         rate_indices=np.array(indices),
+                         sample_rates=np.array(rates), time=event.time,
+                         from_state=-1 if event.from_state is None
+                         else event.from_state,
+                         to_state=event.to_state)
+            except Exception:
+                self.logger.exception('Could not write %s' % path)
+            self._free.put(event)
+
+    def close(self):
+        """ Write the captures that are still collecting samples, and stop
+        the writer """
+        for event in self._active:
+            self._pending.put(event)
+        self._active = []
+        self._pending.put(None)
+        self._writer.join()
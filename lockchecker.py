@@ -4,21 +4,23 @@ import time
 
 
 
-with daqmx_channel_in(num_samples = 10, channel=0) as PID_output:
+# PID output, lockbox error signal and photodiode in one task
+with daqmx_channel_group(num_samples = 10, channels=(0, 1, 2)) as channels:
         while True:
-            PID_output_sig = PID_output.read_voltage()
+            PID_output_sig, error_sig, photodiode_sig = channels.read_voltage()
 
             std = PID_output_sig.std()
 
             if std > 0.3:
-                print "Out of lock: std " , data.std()
+                print "Out of lock: std " , std
             elif std < 0.005:
                 print "Not locking"
             else:
                 print "In lock"
-            
+            print "Error signal: %.3f V, photodiode: %.3f V" % (
+                error_sig.mean(), photodiode_sig.mean())
 
 
-            time.sleep(1)
 
+            time.sleep(1)
 
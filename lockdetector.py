@@ -0,0 +1,171 @@
+import numpy as np
+
+
+def _chunk_stats(data):
+    """ Return count, mean and sum of squared deviations (M2) of data """
+    n = len(data)
+    if n == 0:
+        return 0, 0., 0.
+    mean = data.sum() / n
+    m2 = data.dot(data) - n * mean * mean
+    return n, mean, max(m2, 0.)
+
+
+class LockDetector:
+    """ Decide the lock state from the std over a sliding window of samples.
+
+    The last `window` samples are kept in a ring buffer. For every chunk the
+    statistics of the new samples are merged into the running mean and M2,
+    and those of the samples that drop out of the window are removed
+    (Chan et al., the pairwise form of Welford's algorithm). An update costs
+    O(len(chunk)) regardless of the window length.
+
+    The state has hysteresis: once out of lock, the std has to drop below
+    (1 - hysteresis) * out_of_lock_std to be considered locking again, and
+    once not locking it has to rise above (1 + hysteresis) * not_locking_std.
+
+    Optionally a locking lockbox whose output oscillates counts as out of
+    lock: pass the power in some frequency bands to update() and a limit
+    per band as max_band_power. Leaving that state takes all powers below
+    (1 - hysteresis) times their limits.
+
+    Example:
+    detector = LockDetector(window=1000)
+    state = detector.update(block)
+    """
+
+    NOT_LOCKING = 0
+    LOCKING = 1
+    OUT_OF_LOCK = 2
+
+    def __init__(self, window=10, out_of_lock_std=0.3, not_locking_std=0.005,
+                 hysteresis=0.1, max_band_power=None):
+        """
+        arguments:
+        max_band_power -- limits of the band powers, None for no limit; a
+                          sequence with a limit or None per band
+        """
+        self.window = int(window)
+        self.out_of_lock_std = out_of_lock_std
+        self.not_locking_std = not_locking_std
+        self.hysteresis = hysteresis
+        self.max_band_power = None
+        if max_band_power is not None:
+            self.max_band_power = np.array(
+                [np.inf if limit is None else limit
+                 for limit in max_band_power], dtype=np.float64)
+
+        self._samples = np.zeros(self.window, dtype=np.float64)
+        self.reset()
+
+    def reset(self):
+        """ Forget all samples and the state """
+        self._head = 0  # index of the oldest sample
+        self.n = 0
+        self.mean = 0.
+        self._m2 = 0.
+        self._since_resync = 0
+        self.state = None
+
+    @property
+    def variance(self):
+        if self.n == 0:
+            return 0.
+        return self._m2 / self.n
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+    def _merge(self, n, mean, m2):
+        total = self.n + n
+        if total == 0:
+            return
+        delta = mean - self.mean
+        self._m2 += m2 + delta * delta * self.n * n / total
+        self.mean += delta * n / total
+        self.n = total
+
+    def _remove(self, n, mean, m2):
+        total = self.n - n
+        if total <= 0:
+            self.n, self.mean, self._m2 = 0, 0., 0.
+            return
+        mean_rest = (self.n * self.mean - n * mean) / total
+        delta = mean - mean_rest
+        self._m2 = max(self._m2 - m2 - delta * delta * total * n / self.n, 0.)
+        self.mean = mean_rest
+        self.n = total
+
+    def _resync(self):
+        """ Recompute the statistics from the window, removes rounding drift """
+        start = self._head
+        stop = start + self.n
+        if stop <= self.window:
+            parts = [self._samples[start:stop]]
+        else:
+            parts = [self._samples[start:], self._samples[:stop - self.window]]
+        self.n, self.mean, self._m2 = 0, 0., 0.
+        for part in parts:
+            self._merge(*_chunk_stats(part))
+        self._since_resync = 0
+
+    def update(self, chunk, band_powers=None):
+        """ Add the samples in chunk and return the new lock state, with
+        band_powers the power per band of max_band_power """
+        if len(chunk) >= self.window:
+            # the chunk fills the whole window
+            self._samples[:] = chunk[-self.window:]
+            self._head = 0
+            self.n, self.mean, self._m2 = _chunk_stats(self._samples)
+            self._since_resync = 0
+        else:
+            k = len(chunk)
+            evict = max(self.n + k - self.window, 0)
+            # remove the oldest samples
+            start = self._head
+            stop = start + evict
+            if stop <= self.window:
+                self._remove(*_chunk_stats(self._samples[start:stop]))
+            else:
+                self._remove(*_chunk_stats(self._samples[start:]))
+                self._remove(*_chunk_stats(self._samples[:stop - self.window]))
+            self._head = stop % self.window
+            # write the new samples after the remaining ones
+            start = (self._head + self.n) % self.window
+            stop = start + k
+            if stop <= self.window:
+                self._samples[start:stop] = chunk
+            else:
+                split = self.window - start
+                self._samples[start:] = chunk[:split]
+                self._samples[:stop - self.window] = chunk[split:]
+            self._merge(*_chunk_stats(chunk))
+
+            self._since_resync += k
+            if self._since_resync >= self.window:
+                self._resync()
+
+        self.state = self._classify(self.std, band_powers)
+        return self.state
+
+    def _classify(self, std, band_powers=None):
+        out_of_lock_std = self.out_of_lock_std
+        not_locking_std = self.not_locking_std
+        band_scale = 1.
+        if self.state == self.OUT_OF_LOCK:
+            out_of_lock_std *= 1 - self.hysteresis
+            band_scale = 1 - self.hysteresis
+        elif self.state == self.NOT_LOCKING:
+            not_locking_std *= 1 + self.hysteresis
+
+        if std > out_of_lock_std:
+            return self.OUT_OF_LOCK
+        elif std < not_locking_std:
+            return self.NOT_LOCKING
+        elif self.max_band_power is not None and band_powers is not None \
+                and np.any(band_powers > band_scale * self.max_band_power):
+            # the PID output oscillates
+            return self.OUT_OF_LOCK
+        else:
+            return self.LOCKING
@@ -0,0 +1,140 @@
+import numpy as np
+from history import CircularArray
+
+
+class _Bucket:
+    """ Running aggregate of samples that are not a complete bucket yet """
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.n = 0
+        self.time = 0.
+        self.min = np.inf
+        self.max = -np.inf
+        self.sum = 0.
+
+    def add(self, n, time, vmin, vmax, total):
+        if self.n == 0:
+            self.time = time
+        self.n += n
+        self.min = min(self.min, vmin)
+        self.max = max(self.max, vmax)
+        self.sum += total
+
+
+class MinMaxPyramid:
+    """ Multi-resolution min/max/mean decimation of a time series.
+
+    Level 0 holds the samples themselves, every next level holds buckets of
+    `factor` entries of the level below with their start time, minimum,
+    maximum and mean. All levels are ring buffers of `length` entries, so
+    the coarse levels reach much further back. Appending is O(1) amortized.
+
+    query() picks the finest level that has at most max_points entries in
+    the requested range. Because every bucket keeps its extremes, short
+    spikes stay visible at any resolution.
+
+    Example:
+    pyramid = MinMaxPyramid()
+    pyramid.append(t, value)
+    x, y = pyramid.envelope(t - 3600, t, 800)
+    line.set_data(x, y)
+    """
+
+    def __init__(self, length=4096, factor=8, levels=6):
+        self.length = length
+        self.factor = factor
+        self.levels = []
+        for level in range(levels):
+            self.levels.append({'time': CircularArray(length),
+                                'min': CircularArray(length),
+                                'max': CircularArray(length),
+                                'mean': CircularArray(length)})
+        # incomplete bucket of every level, level 0 has none
+        self._pending = [_Bucket() for level in range(levels)]
+
+    def append(self, time, value):
+        """ Add a sample, times have to be non-decreasing """
+        self._store(0, time, value, value, value)
+        n, vmin, vmax, total = 1, value, value, value
+        for level in range(1, len(self.levels)):
+            bucket = self._pending[level]
+            bucket.add(n, time, vmin, vmax, total)
+            if bucket.n < self.factor ** level:
+                return
+            # the bucket is complete, move it to its level
+            n, time, vmin, vmax, total = (bucket.n, bucket.time, bucket.min,
+                                          bucket.max, bucket.sum)
+            self._store(level, time, vmin, vmax, total / n)
+            bucket.clear()
+
+    def extend(self, times, values):
+        for time, value in zip(times, values):
+            self.append(time, value)
+
+    def _store(self, level, time, vmin, vmax, mean):
+        columns = self.levels[level]
+        columns['time'].append(time)
+        columns['min'].append(vmin)
+        columns['max'].append(vmax)
+        columns['mean'].append(mean)
+
+    def first_time(self):
+        """ Time of the oldest sample that is still represented """
+        for columns in reversed(self.levels):
+            if len(columns['time']):
+                return columns['time'][0]
+        return None
+
+    def last_time(self):
+        times = self.levels[0]['time']
+        return times[-1] if len(times) else None
+
+    def _pending_after(self, level):
+        """ Aggregate of the samples that are not yet in a bucket of level """
+        tail = _Bucket()
+        # oldest first, the tail starts at the time of the oldest samples
+        for bucket in reversed(self._pending[1:level + 1]):
+            if bucket.n:
+                tail.add(bucket.n, bucket.time, bucket.min, bucket.max,
+                         bucket.sum)
+        return tail
+
+    def query(self, start, stop, max_points):
+        """ Return (time, min, max, mean) arrays covering [start, stop] with
+        at most about max_points entries """
+        chosen = len(self.levels) - 1
+        for level, columns in enumerate(self.levels):
+            times = columns['time']
+            if not len(times):
+                continue
+            window = times.window(start, stop)
+            covers = times[0] <= start or len(times) < self.length
+            if covers and window.stop - window.start <= max_points:
+                chosen = level
+                break
+
+        columns = self.levels[chosen]
+        window = columns['time'].window(start, stop)
+        if chosen > 0 and window.start > 0:
+            # the bucket that started before start also covers part of it
+            window = slice(window.start - 1, window.stop)
+        result = [np.array(columns[name].toArray()[window])
+                  for name in ('time', 'min', 'max', 'mean')]
+
+        # the most recent samples that are not in a complete bucket yet
+        tail = self._pending_after(chosen)
+        if tail.n and tail.time <= stop and self.last_time() >= start:
+            for i, value in enumerate((tail.time, tail.min, tail.max,
+                                       tail.sum / tail.n)):
+                result[i] = np.append(result[i], value)
+        return tuple(result)
+
+    def envelope(self, start, stop, max_points):
+        """ Return x, y to plot as one line that traces the minimum and
+        maximum of every bucket """
+        time, vmin, vmax, mean = self.query(start, stop, max_points)
+        x = np.repeat(time, 2)
+        y = np.column_stack((vmin, vmax)).ravel()
+        return x, y
@@ -0,0 +1,166 @@
+import bisect
+import threading
+from scheduler import monotonic
+
+
+def _default_buckets():
+    """ Upper bounds in seconds, 10 us to 10 s in steps of about 2x """
+    buckets = []
+    for exponent in range(-5, 1):
+        for mantissa in (1, 2.5, 5):
+            buckets.append(mantissa * 10 ** exponent)
+    buckets.append(10.)
+    return buckets
+
+
+class Counter:
+    """ Monotonically increasing count """
+    def __init__(self, name, help=''):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def lines(self):
+        return ['%s %d' % (self.name, self.value)]
+
+
+class Histogram:
+    """ Distribution of durations in fixed buckets.
+
+    observe() is a bisect and two additions, cheap enough to leave on in
+    the control loop.
+    """
+    def __init__(self, name, help='', buckets=None):
+        self.name = name
+        self.help = help
+        if buckets is None:
+            buckets = _default_buckets()
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        """ Context manager that observes the duration of its block """
+        return _Timer(self)
+
+    def lines(self):
+        lines = []
+        cumulative = 0
+        bounds = ['%g' % bound for bound in self.buckets] + ['+Inf']
+        for bound, count in zip(bounds, self.counts):
+            cumulative += count
+            lines.append('%s_bucket{le="%s"} %d' % (self.name, bound,
+                                                    cumulative))
+        lines.append('%s_sum %g' % (self.name, self.sum))
+        lines.append('%s_count %d' % (self.name, self.count))
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = monotonic()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.histogram.observe(monotonic() - self.start)
+
+
+def timed(histogram):
+    """ Decorator that observes the duration of every call in histogram """
+    def decorator(function):
+        def wrapper(*args, **kwargs):
+            start = monotonic()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe(monotonic() - start)
+        wrapper.__name__ = function.__name__
+        wrapper.__doc__ = function.__doc__
+        return wrapper
+    return decorator
+
+
+class Registry:
+    """ Named counters and histograms of this process.
+
+    Metrics are plain Python objects updated without locks; a reader may see
+    a histogram in the middle of an update, which is fine for monitoring.
+    """
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, help, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError('%s is not a %s' % (name, cls.__name__))
+            return metric
+
+    def counter(self, name, help=''):
+        """ Return the counter name, created on first use """
+        return self._get(Counter, name, help)
+
+    def histogram(self, name, help='', buckets=None):
+        """ Return the histogram name, created on first use """
+        return self._get(Histogram, name, help, buckets=buckets)
+
+    def render(self):
+        """ Return all metrics in the Prometheus text format """
+        lines = []
+        for name in sorted(self._metrics):
+            metric = self._metrics[name]
+            kind = 'counter' if isinstance(metric, Counter) else 'histogram'
+            if metric.help:
+                lines.append('# HELP %s %s' % (name, metric.help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            lines.extend(metric.lines())
+        return '\n'.join(lines) + '\n'
+
+
+# the registry used by the feedback loop and the devices
+registry = Registry()
+
+
+def serve(port=9100, address='127.0.0.1', metrics_registry=None):
+    """ Serve the metrics as text on http://address:port/metrics from a
+    daemon thread. Returns the server, call shutdown() to stop it """
+    import BaseHTTPServer
+    if metrics_registry is None:
+        metrics_registry = registry
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = metrics_registry.render()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = BaseHTTPServer.HTTPServer((address, port), Handler)
+    thread = threading.Thread(target=server.serve_forever,
+                              name='metrics server')
+    thread.setDaemon(True)
+    thread.start()
+    return server
@@ -0,0 +1,165 @@
+import numpy as np
+from archive import TelemetryArchive
+
+
+def parameter_grid(**ranges):
+    """ Return a dict of flat arrays with every combination of the values.
+
+    Example:
+    params = parameter_grid(min_signal=np.linspace(1.5, 2.5, 11),
+                            PID_within_bounds_time=[5, 10, 20, 40])
+    """
+    names = sorted(ranges)
+    grids = np.meshgrid(*[np.asarray(ranges[name], dtype=np.float64)
+                          for name in names], indexing='ij')
+    return dict((name, grid.ravel()) for name, grid in zip(names, grids))
+
+
+def load_trace(directory, start, stop):
+    """ Read (time, signal, std) of [start, stop] from a telemetry archive
+    written by feedbackLoop """
+    from temperatureFeedback import feedbackLoop
+    archive = TelemetryArchive(directory, feedbackLoop.telemetry_columns,
+                               readonly=True)
+    data = archive.query(start, stop, columns=('time', 'signal', 'std'))
+    return data['time'], data['signal'], data['std']
+
+
+def defaults():
+    """ Return the parameters of replay() and their defaults, those of
+    feedbackLoop and T255Controller """
+    # imported here, so that importing replay does not load the DAQ and
+    # serial stack
+    from temperatureFeedback import feedbackLoop
+    from T255Controller import T255Controller
+    values = dict(
+        [(name, getattr(feedbackLoop, name))
+         for name in ('min_signal', 'max_signal', 'PID_within_bounds_time',
+                      'out_of_lock_std', 'not_locking_std',
+                      'lock_hysteresis')] +
+        [(name, getattr(T255Controller, name))
+         for name in ('temperature_step', 'lower_temperature_limit',
+                      'higher_temperature_limit')])
+    # set temperature at the start of the trace
+    values['set_temperature'] = 17.7
+    # v per degree, response of the signal to the set temperature
+    values['gain'] = 0.
+    return values
+
+
+def replay(times, signal, std, **params):
+    """ Run the feedback logic of feedbackLoop over a recorded trace for many
+    parameter sets at once.
+
+    The state machine of lockbox_status and performFeedback is stepped
+    through the trace once, with every state variable an array over the
+    parameter sets. Parameters not given take the values of defaults(), all
+    parameters broadcast to the number of parameter sets.
+
+    The lock state follows the hysteresis of LockDetector. The archived std
+    is that of the last num_samples samples of every block, which is the
+    std the detector sees as long as lock_window equals num_samples.
+
+    A recorded trace does not respond to the corrections. With a nonzero
+    gain the signal is shifted by gain * (change of the set temperature) as
+    a simple model of that response.
+
+    arguments:
+    times, signal, std -- time, block mean and block std of the trace, e.g.
+                          from load_trace()
+    return:
+        dict of arrays over the parameter sets: corrections, raises,
+        lowers, limit_hits, time_out_of_bounds, time_locked and
+        set_temperature (at the end of the trace)
+    """
+    values = defaults()
+    for name in params:
+        if name not in values:
+            raise ValueError('Unknown parameter %s' % name)
+    values.update(params)
+    size = max(np.size(value) for value in values.values())
+    p = dict((name, np.broadcast_to(np.asarray(value, dtype=np.float64),
+                                    (size,)))
+             for name, value in values.items())
+
+    times = np.asarray(times, dtype=np.float64)
+    signal = np.asarray(signal, dtype=np.float64)
+    std = np.asarray(std, dtype=np.float64)
+    dt = np.zeros(len(times))
+    dt[1:] = np.diff(times)
+
+    set_temperature = p['set_temperature'].copy()
+    initial_temperature = p['set_temperature']
+    t0 = np.full(size, times[0] if len(times) else 0.)
+    within_bounds = np.ones(size, dtype=bool)
+    raises = np.zeros(size, dtype=np.int64)
+    lowers = np.zeros(size, dtype=np.int64)
+    limit_hits = np.zeros(size, dtype=np.int64)
+    time_out_of_bounds = np.zeros(size)
+    time_locked = np.zeros(size)
+
+    # lock state of LockDetector, -1 before the first block
+    state = np.full(size, -1, dtype=np.int64)
+    out_of_lock_std = np.zeros(size)
+    not_locking_std = np.zeros(size)
+
+    # preallocated work arrays
+    mean = np.zeros(size)
+    locked = np.zeros(size, dtype=bool)
+    low = np.zeros(size, dtype=bool)
+    high = np.zeros(size, dtype=bool)
+    act = np.zeros(size, dtype=bool)
+    target = np.zeros(size)
+    hit = np.zeros(size, dtype=bool)
+
+    for k in range(len(times)):
+        t = times[k]
+        # lockbox_status, the thresholds move away from the current state
+        np.copyto(out_of_lock_std, p['out_of_lock_std'])
+        out_of_lock_std[state == 2] *= 1 - p['lock_hysteresis'][state == 2]
+        np.copyto(not_locking_std, p['not_locking_std'])
+        not_locking_std[state == 0] *= 1 + p['lock_hysteresis'][state == 0]
+        state[:] = 1
+        state[std[k] < not_locking_std] = 0
+        state[std[k] > out_of_lock_std] = 2
+        np.equal(state, 1, out=locked)
+        t0[~locked] = t
+        time_locked += locked * dt[k]
+
+        # performFeedback
+        np.subtract(set_temperature, initial_temperature, out=mean)
+        mean *= p['gain']
+        mean += signal[k]
+        np.less(mean, p['min_signal'], out=low)
+        low &= locked
+        np.greater(mean, p['max_signal'], out=high)
+        high &= locked
+        time_out_of_bounds += (low | high) * dt[k]
+        t0[low | high] = t
+
+        for direction, outside, count in ((1, low, raises),
+                                          (-1, high, lowers)):
+            np.logical_and(outside, within_bounds, out=act)
+            if not act.any():
+                continue
+            np.multiply(p['temperature_step'], direction, out=target)
+            target += set_temperature
+            hit[:] = act & ((target > p['higher_temperature_limit']) |
+                            (target < p['lower_temperature_limit']))
+            limit_hits += hit
+            act &= ~hit
+            count += act
+            # the T255 set point has a resolution of 0.1 degree
+            set_temperature[act] = np.round(10 * target[act]) / 10.
+            within_bounds[outside & within_bounds] = False
+
+        inside = locked & ~low & ~high
+        within_bounds[inside & (t - t0 > p['PID_within_bounds_time'])] = True
+
+    return {'corrections': raises + lowers,
+            'raises': raises,
+            'lowers': lowers,
+            'limit_hits': limit_hits,
+            'time_out_of_bounds': time_out_of_bounds,
+            'time_locked': time_locked,
+            'set_temperature': set_temperature}
@@ -0,0 +1,158 @@
+import time
+import sys
+import ctypes
+import ctypes.util
+import logging
+import numpy as np
+
+
+def _clock_gettime_monotonic():
+    """ Return a monotonic() function based on clock_gettime """
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    CLOCK_MONOTONIC = 1
+    library = ctypes.util.find_library('rt') or ctypes.util.find_library('c')
+    clock_gettime = ctypes.CDLL(library, use_errno=True).clock_gettime
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    t = timespec()
+
+    def monotonic():
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+            raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+        return t.tv_sec + t.tv_nsec * 1e-9
+    return monotonic
+
+
+if hasattr(time, 'monotonic'):
+    monotonic = time.monotonic
+elif sys.platform == 'win32':
+    # QueryPerformanceCounter, does not jump with the wall clock
+    monotonic = time.clock
+else:
+    monotonic = _clock_gettime_monotonic()
+
+
+class PeriodicTask:
+    """ A function that is called by the Scheduler every period seconds.
+
+    Deadlines lie on a fixed grid start + k * period, so the rate does not
+    drift with the time the function takes. When the function is late by
+    more than a period the skipped deadlines are counted in missed.
+    """
+    def __init__(self, name, period, function):
+        self.name = name
+        self.period = period
+        self.function = function
+        self.deadline = None
+
+        self.runs = 0
+        self.missed = 0
+        self.max_lateness = 0.
+        # running mean and M2 of the lateness and of the start intervals
+        self._lateness = [0, 0., 0.]
+        self._interval = [0, 0., 0.]
+        self._last_start = None
+
+    @staticmethod
+    def _add(stats, value):
+        stats[0] += 1
+        delta = value - stats[1]
+        stats[1] += delta / stats[0]
+        stats[2] += delta * (value - stats[1])
+
+    def _run(self, now):
+        lateness = now - self.deadline
+        self._add(self._lateness, lateness)
+        self.max_lateness = max(self.max_lateness, lateness)
+        if self._last_start is not None:
+            self._add(self._interval, now - self._last_start)
+        self._last_start = now
+
+        self.runs += 1
+        self.function()
+
+    def _advance(self, now):
+        """ Move the deadline to the next grid point after now """
+        self.deadline += self.period
+        if now > self.deadline:
+            missed = int((now - self.deadline) / self.period) + 1
+            self.missed += missed
+            self.deadline += missed * self.period
+        return self.deadline
+
+    def stats(self):
+        """ Return a dict with the timing statistics of the task """
+        n, mean, m2 = self._interval
+        return {'runs': self.runs,
+                'missed': self.missed,
+                'mean_lateness': self._lateness[1],
+                'max_lateness': self.max_lateness,
+                'mean_period': mean,
+                'period_jitter': np.sqrt(m2 / n) if n else 0.}
+
+
+class Scheduler:
+    """ Run several periodic tasks at independent rates in one thread.
+
+    Tasks that are due at the same time run in the order they were added.
+
+    Example:
+    scheduler = Scheduler()
+    scheduler.add('acquire', 0.1, acquire)
+    scheduler.add('feedback', 1., feedback)
+    scheduler.run()
+    """
+    def __init__(self, clock=monotonic):
+        self.clock = clock
+        self.tasks = []
+        self._running = False
+        self.logger = logging.getLogger('scheduler')
+
+    def add(self, name, period, function):
+        """ Add a task, it first runs when the scheduler starts """
+        task = PeriodicTask(name, period, function)
+        self.tasks.append(task)
+        return task
+
+    def set_period(self, task, period):
+        """ Change the period of a task returned by add(). A shorter period
+        takes effect at once, the next run is then at most period after the
+        last one """
+        task.period = period
+        if task.deadline is not None and task._last_start is not None:
+            task.deadline = min(task.deadline, task._last_start + period)
+
+    def _next_task(self):
+        task = self.tasks[0]
+        for other in self.tasks[1:]:
+            if other.deadline < task.deadline:
+                task = other
+        return task
+
+    def run(self):
+        """ Run the tasks until stop() is called """
+        self._running = True
+        start = self.clock()
+        for task in self.tasks:
+            task.deadline = start
+        while self._running:
+            task = self._next_task()
+            delay = task.deadline - self.clock()
+            if delay > 0:
+                time.sleep(delay)
+            now = self.clock()
+            task._run(now)
+            missed = task.missed
+            task._advance(self.clock())
+            if task.missed > missed:
+                self.logger.debug('%s missed %d deadlines' %
+                                  (task.name, task.missed - missed))
+
+    def stop(self):
+        """ Stop run() after the current task """
+        self._running = False
+
+    def stats(self):
+        """ Return the timing statistics of all tasks by name """
+        return dict((task.name, task.stats()) for task in self.tasks)
@@ -0,0 +1,134 @@
+import numpy as np
+
+
+class StreamingPSD:
+    """ Welch estimate of the power spectral density of a sample stream.
+
+    Samples are collected in a buffer of one segment. Every `step` new
+    samples the segment is detrended (mean removed), multiplied with a Hann
+    window and transformed, and its periodogram is averaged into the PSD
+    with an exponential weight alpha. The PSD thus follows the signal with
+    a memory of about 1 / alpha segments.
+
+    All work arrays are allocated once; only the FFT itself returns a new
+    array, numpy has no output argument for it. By default every segment of
+    a chunk is averaged in, so the cost of an update grows with the chunk,
+    about 30 us per segment. With max_segments only the last max_segments
+    segments of a long chunk are transformed and the older ones skipped.
+
+    Example:
+    psd = StreamingPSD(sample_rate=1e4, bands=((10., 100.), (100., 1000.)))
+    psd.update(block)
+    low, high = psd.band_powers
+    """
+
+    def __init__(self, sample_rate, segment=256, overlap=0.5, alpha=0.1,
+                 bands=(), max_segments=None):
+        """
+        arguments:
+        segment      -- samples per FFT
+        overlap      -- fraction of a segment shared with the next one
+        alpha        -- weight of a new periodogram in the average
+        bands        -- (low, high) frequency ranges in Hz to integrate the
+                        PSD over, see band_powers
+        max_segments -- maximum number of FFTs per update, None for all
+        """
+        self.segment = int(segment)
+        self.step = max(int(round(self.segment * (1 - overlap))), 1)
+        self.alpha = alpha
+        self.bands = tuple(bands)
+        self.max_segments = max_segments
+
+        self.window = np.hanning(self.segment)
+        self._buffer = np.zeros(self.segment)
+        self._work = np.zeros(self.segment)
+        size = self.segment // 2 + 1
+        self._power = np.zeros(size)
+        self._square = np.zeros(size)
+        self.psd = np.zeros(size)
+        self.band_powers = np.zeros(len(self.bands))
+        self.reset(sample_rate)
+
+    def reset(self, sample_rate=None):
+        """ Forget the samples and the average, e.g. when the sample rate
+        changes """
+        if sample_rate is not None:
+            self.sample_rate = float(sample_rate)
+            self.frequencies = np.fft.rfftfreq(self.segment,
+                                               1. / self.sample_rate)
+            # one sided density: the bins between DC and Nyquist count twice
+            self._scale = np.full(len(self.frequencies), 2. / (
+                self.sample_rate * (self.window ** 2).sum()))
+            self._scale[0] /= 2
+            if self.segment % 2 == 0:
+                self._scale[-1] /= 2
+            # band powers are one matrix product with the PSD
+            df = self.sample_rate / self.segment
+            self._bands = np.zeros((len(self.bands), len(self.frequencies)))
+            for i, (low, high) in enumerate(self.bands):
+                inside = (self.frequencies >= low) & (self.frequencies <= high)
+                self._bands[i, inside] = df
+        self._filled = 0  # samples in the buffer
+        self._new = 0  # samples since the last segment
+        self.segments = 0  # periodograms in the average
+        self.psd[:] = 0.
+        self.band_powers[:] = 0.
+
+    def update(self, chunk):
+        """ Add the samples of chunk, return the number of new segments """
+        n = len(chunk)
+        # samples older than max_segments segments are not used
+        keep = n
+        if self.max_segments is not None:
+            keep = self.segment + (self.max_segments - 1) * self.step
+        if n > keep:
+            chunk = chunk[-keep:]
+            n = keep
+            self._filled = 0
+            self._new = 0
+        done = 0
+        position = 0
+        while position < n:
+            if self._filled < self.segment:
+                # fill the buffer
+                k = min(self.segment - self._filled, n - position)
+                self._buffer[self._filled:self._filled + k] = \
+                    chunk[position:position + k]
+                self._filled += k
+                complete = self._filled == self.segment
+            else:
+                # slide the buffer towards the next segment
+                k = min(self.step - self._new, n - position)
+                self._buffer[:-k] = self._buffer[k:]
+                self._buffer[-k:] = chunk[position:position + k]
+                self._new += k
+                complete = self._new == self.step
+            position += k
+            if complete:
+                self._transform()
+                self._new = 0
+                done += 1
+        if done:
+            self._integrate()
+        return done
+
+    def _transform(self):
+        work = self._work
+        np.subtract(self._buffer, self._buffer.mean(), out=work)
+        work *= self.window
+        spectrum = np.fft.rfft(work)
+        np.multiply(spectrum.real, spectrum.real, out=self._power)
+        np.multiply(spectrum.imag, spectrum.imag, out=self._square)
+        self._power += self._square
+        self._power *= self._scale
+        if self.segments == 0:
+            self.psd[:] = self._power
+        else:
+            # psd += alpha * (power - psd)
+            self._power -= self.psd
+            self._power *= self.alpha
+            self.psd += self._power
+        self.segments += 1
+
+    def _integrate(self):
+        np.dot(self._bands, self.psd, out=self.band_powers)
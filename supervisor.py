@@ -0,0 +1,206 @@
+import os
+import ast
+import ConfigParser
+from daqmx_channel import daqmx_channel_group, BufferPool
+from T255Controller import T255Controller
+from temperatureFeedback import feedbackLoop
+from scheduler import Scheduler
+import metrics
+from telemetryserver import TelemetryServer
+
+# options of a section that are not feedbackLoop settings
+DEVICE_OPTIONS = ('regulator', 'comport', 'device', 'channel')
+# options of a section that are attributes of the regulator
+REGULATOR_OPTIONS = ('lower_temperature_limit', 'higher_temperature_limit',
+                     'temperature_step', 'reconcile_interval')
+REGULATORS = {'T255': T255Controller}
+
+
+def _convert(value, default):
+    """ Convert the string value of an ini option to the type of default """
+    if value == 'None':
+        return None
+    if isinstance(default, bool):
+        return value.lower() in ('1', 'yes', 'true', 'on')
+    if isinstance(default, float):
+        return float(value)
+    if isinstance(default, int):
+        return int(value)
+    if isinstance(default, (tuple, list)):
+        # e.g. psd_bands = ((50, 500), (500, 2000))
+        return tuple(ast.literal_eval(value))
+    if default is None:
+        # a number, a tuple like max_band_power or a plain string
+        try:
+            return ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            return value
+    return value
+
+
+class GroupChannel:
+    """ One channel of a daqmx_channel_group, read by the supervisor.
+
+    Looks like a continuous daqmx_channel_in to a feedbackLoop: read_available
+    returns the row of this channel from the last read of the group, or None
+    when the group was not read since the previous call, so a loop that runs
+    its acquisition faster than the supervisor does not process a block
+    twice. The row stays valid until the group buffer is reused, see
+    BufferPool.
+    """
+    def __init__(self, supervisor, group, index):
+        self.supervisor = supervisor
+        self.group = group
+        self.index = index
+        self.buffer_size = group.buffer_size
+        self.clockspeed = group.clockspeed
+        self._reads = 0  # reads of the group at the previous call
+
+    def read_available(self, out=None):
+        reads = self.supervisor.reads.get(self.group, 0)
+        if reads == self._reads:
+            return None
+        self._reads = reads
+        return self.supervisor.blocks[self.group][self.index]
+
+    def cleanup(self):
+        pass
+
+
+class Supervisor:
+    """ Run a feedback loop for every laser in Regulators.ini.
+
+    Every section with a 'channel' option describes one loop:
+
+    [laser1]
+    regulator = T255
+    comport = COM11
+    device = 1
+    channel = 0
+    min_signal = 2.2
+    max_signal = 4.0
+
+    'device' defaults to 1. The other options are feedbackLoop settings. All
+    channels of a device are read in a single continuous DAQmx task, and
+    all loops run their stages on one Scheduler in one thread. Every serial
+    port gets the worker thread of its regulator, which sleeps until a
+    command is queued.
+
+    Example:
+    supervisor = Supervisor('Regulators.ini')
+    supervisor.run()
+    """
+
+    def __init__(self, filename='Regulators.ini', clockspeed=10000.0,
+                 metrics_port=None, telemetry_port=None):
+        self.configparser = ConfigParser.SafeConfigParser()
+        if not self.configparser.read(filename):
+            raise IOError('Could not read %s' % filename)
+
+        sections = [section for section in self.configparser.sections()
+                    if self.configparser.has_option(section, 'channel')]
+        self.scheduler = Scheduler()
+
+        # one task per DAQ device for all channels
+        channels = {}
+        for section in sections:
+            device = self._getint(section, 'device', 1)
+            channel = self.configparser.getint(section, 'channel')
+            channels.setdefault(device, []).append((section, channel))
+        self.groups = {}
+        self.pools = {}
+        self.blocks = {}
+        self.reads = {}  # number of reads per group
+        positions = {}
+        for device, members in sorted(channels.items()):
+            group = daqmx_channel_group(
+                device=device,
+                channels=[channel for section, channel in members],
+                clockspeed=clockspeed,
+                num_samples=feedbackLoop.num_samples, continuous=True)
+            self.groups[device] = group
+            self.pools[group] = BufferPool(group.num_channels *
+                                           group.buffer_size)
+            for index, (section, channel) in enumerate(members):
+                positions[section] = (group, index)
+        # the group reads run before the stages of the loops
+        self.scheduler.add('acquisition', feedbackLoop.acquisition_period,
+                           self.acquire)
+
+        self.loops = []
+        for section in sections:
+            group, index = positions[section]
+            self.loops.append(self._create_loop(section,
+                                                GroupChannel(self, group,
+                                                             index)))
+
+        if metrics_port is not None:
+            metrics.serve(metrics_port)
+
+        self.telemetry = None
+        if telemetry_port is not None:
+            self.telemetry = TelemetryServer(self.loops, telemetry_port)
+
+    def _getint(self, section, option, default):
+        if self.configparser.has_option(section, option):
+            return self.configparser.getint(section, option)
+        return default
+
+    def _create_loop(self, section, PID_output):
+        regulator = 'T255'
+        if self.configparser.has_option(section, 'regulator'):
+            regulator = self.configparser.get(section, 'regulator')
+        cooler = REGULATORS[regulator](
+            comport=self.configparser.get(section, 'comport'))
+        cooler.configparser = self.configparser
+        cooler.section_name = section
+
+        # ConfigParser lower-cases the option names, only plain class
+        # attributes are settings, properties are computed from them
+        names = dict((name.lower(), name) for name in dir(feedbackLoop)
+                     if not name.startswith('_') and
+                     not callable(getattr(feedbackLoop, name)) and
+                     not isinstance(getattr(feedbackLoop, name), property))
+        # every loop archives and captures to its own directory, the
+        # supervisor serves the metrics and telemetry of all loops
+        settings = {'metrics_port': None, 'telemetry_port': None}
+        for name in ('archive_directory', 'capture_directory'):
+            directory = getattr(feedbackLoop, name)
+            if directory is not None:
+                settings[name] = os.path.join(directory, section)
+        for option in self.configparser.options(section):
+            if option in DEVICE_OPTIONS:
+                continue
+            value = self.configparser.get(section, option)
+            if option in REGULATOR_OPTIONS:
+                setattr(cooler, option,
+                        _convert(value, getattr(cooler, option)))
+            elif option in names:
+                name = names[option]
+                settings[name] = _convert(value, getattr(feedbackLoop, name))
+            else:
+                raise ValueError('Unknown option %s in section %s' %
+                                 (option, section))
+        return feedbackLoop(PID_output=PID_output, cooler=cooler,
+                            scheduler=self.scheduler, name=section,
+                            **settings)
+
+    def acquire(self):
+        """ Read all channels of every device in one transaction each """
+        for group in self.groups.values():
+            self.blocks[group] = group.read_available(
+                out=self.pools[group].next())
+            self.reads[group] = self.reads.get(group, 0) + 1
+
+    def run(self):
+        """ Run all loops in this thread until stop() """
+        self.scheduler.run()
+
+    def stop(self):
+        self.scheduler.stop()
+
+    def cleanup(self):
+        for loop in self.loops:
+            loop.cooler.close()
+        for group in self.groups.values():
+            group.cleanup()
@@ -0,0 +1,123 @@
+""" Frames of the T255 chiller serial protocol.
+
+A frame is a body of ascii characters, a checksum and a carriage return.
+The checksum is the sum of the character codes of the body modulo 256, in
+hex. Replies repeat the command letter after the dot, so the replies of
+several queries written at once can be told apart.
+
+Example:
+serial.write(QUERIES['set_temperature'] + QUERIES['coolant_temperature'])
+replies = [read_reply(serial), read_reply(serial)]
+values = demultiplex(('set_temperature', 'coolant_temperature'), replies)
+"""
+import binascii
+
+TERMINATOR = '\r'
+
+# lowest and highest set temperature that fits the three digits of .M+
+MIN_SET_TEMPERATURE = 10.0
+MAX_SET_TEMPERATURE = 99.9
+
+
+def hex2Ascii(hexStr):
+    """ Convert hex to ascii string """
+    return binascii.a2b_hex(hexStr)
+
+
+def ascii2Hex(asciiStr):
+    return ''.join([hex(ord(c)) for c in asciiStr])
+
+
+def checksum(body):
+    """ Sum of the character codes of body modulo 256 """
+    return sum(bytearray(body)) & 0xff
+
+
+def encode(body):
+    """ Return the frame of body, with an upper case two digit checksum """
+    return '%s%02X%s' % (body, checksum(body), TERMINATOR)
+
+
+def _parse_coolant_temperature(reply):
+    return float(reply[3:8]) / 100
+
+
+def _parse_set_temperature(reply):
+    return float(reply[4:8]) / 10.
+
+
+def _parse_new_set_temperature(reply):
+    return float(reply[4:7]) / 10.
+
+
+# precompiled frames of the queries, and the parsers of their replies
+QUERIES = {
+    'coolant_temperature': hex2Ascii('2E4937370D'),  # .I77
+    'set_temperature': hex2Ascii('2E483041360D'),  # .H0A6
+}
+PARSERS = {
+    'coolant_temperature': _parse_coolant_temperature,
+    'set_temperature': _parse_set_temperature,
+    'new_set_temperature': _parse_new_set_temperature,
+}
+
+
+def _set_temperature_frame(tenths):
+    body = '.M+%i' % tenths
+    # lower case checksum without leading zero, as the device was always sent
+    return '%s%x%s' % (body, checksum(body), TERMINATOR)
+
+# frames of all set temperatures, by temperature in tenths of a degree
+_SET_FRAMES = dict((tenths, _set_temperature_frame(tenths))
+                   for tenths in range(int(MIN_SET_TEMPERATURE * 10),
+                                       int(MAX_SET_TEMPERATURE * 10) + 1))
+
+
+def set_temperature_frame(temperature):
+    """ Return the frame that sets temperature, rounded to 0.1 degree """
+    tenths = int(round(10 * temperature))
+    try:
+        return _SET_FRAMES[tenths]
+    except KeyError:
+        raise ValueError('Set temperature %.1f out of range' % temperature)
+
+
+def read_reply(serial):
+    """ Read one reply from serial, up to and including the terminator.
+    Returns what was read before the timeout if the reply is incomplete """
+    if hasattr(serial, 'read_until'):
+        return serial.read_until(TERMINATOR)
+    return serial.readline(eol=TERMINATOR)  # pyserial 2
+
+
+def parse(name, reply):
+    """ Return the value of the reply to query name. Raises ValueError for
+    a reply that is incomplete or garbled """
+    # a device that ends replies with \r\n leaves the \n in front of the next
+    reply = reply.lstrip('\n')
+    if not reply.endswith(TERMINATOR):
+        raise ValueError('Incomplete reply %r' % reply)
+    return PARSERS[name](reply)
+
+
+def demultiplex(names, replies):
+    """ Match the replies to the queries names by their command letter.
+
+    Returns a dict of the values by name; the value of a query without a
+    valid reply is a ValueError instance.
+    """
+    values = {}
+    pending = list(names)
+    for reply in replies:
+        stripped = reply.lstrip('\n')
+        for name in pending:
+            if stripped[1:2] == QUERIES[name][1]:
+                pending.remove(name)
+                try:
+                    values[name] = parse(name, stripped)
+                except ValueError as e:
+                    values[name] = e
+                break
+    for name in pending:
+        values[name] = ValueError('No reply to %s' % name)
+    return values
@@ -0,0 +1,314 @@
+""" Stream the history, lock state and chiller readings of feedback loops
+to local clients over TCP.
+
+Every frame is a header of a type byte and a uint32 payload length,
+followed by the payload, all little endian:
+
+HELLO   (0) once on connect: uint16 version, then for every loop its name
+            and its history columns, as lines 'name:column,column,...'
+KEY     (1) uint8 loop, uint32 count, uint32 n, then n float64 values of
+            every column, one column after the other. count is the number of
+            appends to the history after the last of these samples
+DELTA   (2) as KEY, but float32 differences with the previous value of the
+            column as the client has it: the first with the last sample sent
+            before, the others with their predecessor
+STATE   (3) uint8 loop, int8 lock state (-1 unknown), uint8 active, float32
+            set and coolant temperature (NaN unknown). Only sent on a change
+
+The first samples a client gets of every loop are a KEY frame, later ones
+DELTA frames. A float32 difference is about half the size of a float64
+sample and exact to its own seventh digit; the differences are computed
+against the values the client reconstructs, so the rounding does not add
+up. Every keyframe_interval frames of a loop, and after a gap, the client
+gets a KEY frame again.
+
+Backpressure: a client whose unsent output exceeds max_pending bytes gets
+no new frames until it has read them. It then gets all samples it missed
+in one frame, as far as they are still in the history; samples that were
+overwritten meanwhile give a KEY frame. A slow client only falls behind
+itself, and the server reads the histories with History.snapshot(), so the
+loops never wait for it.
+
+Example:
+server = TelemetryServer([loop], port=9200)  # serves from a daemon thread
+for loop_index, count, data in read_frames(socket):  # in a client
+    ...
+"""
+import socket
+import struct
+import asyncore
+import logging
+import threading
+import numpy as np
+from metrics import registry
+from scheduler import monotonic
+
+VERSION = 1
+HELLO, KEY, DELTA, STATE = range(4)
+
+_header = struct.Struct('<BI')
+_samples = struct.Struct('<BII')
+_state = struct.Struct('<BbBff')
+
+clients_total = registry.counter('telemetry_clients_total',
+                                 'Clients connected to the telemetry server')
+throttled = registry.counter('telemetry_throttled_total',
+                             'Frames not sent to a client that did not '
+                             'read its output')
+
+
+def frame(type, payload):
+    return _header.pack(type, len(payload)) + payload
+
+
+class _Stream:
+    """ What one client has of one loop """
+    def __init__(self, num_columns):
+        self.count = None  # history count of the last sample sent
+        self.values = np.zeros(num_columns)  # last values the client has
+        self.frames = 0  # DELTA frames since the last KEY frame
+        self.state = None
+
+
+class _Client(asyncore.dispatcher):
+
+    def __init__(self, server, sock, map):
+        asyncore.dispatcher.__init__(self, sock, map=map)
+        self.server = server
+        self.output = []
+        self.pending = 0
+        self.streams = [_Stream(len(loop.history.columns))
+                        for loop in server.loops]
+        self.send_frame(server.hello)
+
+    def send_frame(self, data):
+        self.output.append(data)
+        self.pending += len(data)
+
+    @property
+    def congested(self):
+        return self.pending > self.server.max_pending
+
+    def writable(self):
+        return self.pending > 0
+
+    def handle_write(self):
+        data = ''.join(self.output)
+        sent = self.send(data)
+        data = data[sent:]
+        self.output = [data] if data else []
+        self.pending = len(data)
+
+    def handle_read(self):
+        # clients only listen, discard what they send
+        self.recv(4096)
+
+    def handle_close(self):
+        self.close()
+
+    def handle_error(self):
+        self.server.logger.exception('Telemetry client failed')
+        self.close()
+
+
+class TelemetryServer(asyncore.dispatcher):
+    """ Serve the loops from a daemon thread, see the module docstring.
+
+    The histories are polled every period seconds, so a frame holds the
+    samples of the last period.
+    """
+
+    def __init__(self, loops, port=9200, address='127.0.0.1', period=0.1,
+                 max_pending=1 << 20, keyframe_interval=100):
+        """
+        arguments:
+        loops             -- feedbackLoops, the index in this list is the
+                             loop number in the frames
+        max_pending       -- bytes a client may leave unread before it is
+                             throttled
+        keyframe_interval -- DELTA frames between KEY frames of a loop
+        """
+        self.loops = list(loops)
+        self.period = period
+        self.max_pending = max_pending
+        self.keyframe_interval = keyframe_interval
+        self.logger = logging.getLogger('telemetryserver')
+        self._map = {}
+        self._running = True
+
+        lines = ['%s:%s' % (loop.loop_name, ','.join(loop.history.columns))
+                 for loop in self.loops]
+        self.hello = frame(HELLO, struct.pack('<H', VERSION) +
+                           '\n'.join(lines))
+
+        asyncore.dispatcher.__init__(self, map=self._map)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((address, port))
+        self.listen(5)
+        self.port = self.socket.getsockname()[1]
+
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        name='telemetry server')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is None:
+            return
+        clients_total.inc()
+        _Client(self, pair[0], self._map)
+
+    @property
+    def clients(self):
+        return [channel for channel in self._map.values()
+                if isinstance(channel, _Client)]
+
+    def serve_forever(self):
+        due = monotonic()
+        while self._running:
+            asyncore.loop(timeout=max(due - monotonic(), 0), map=self._map,
+                          count=1)
+            if monotonic() < due:
+                continue
+            due = max(due + self.period, monotonic())
+            try:
+                self.publish()
+            except Exception:
+                self.logger.exception('Could not publish telemetry')
+        for channel in self._map.values():
+            channel.close()
+
+    def publish(self):
+        """ Queue the new samples and states for all clients """
+        clients = self.clients
+        if not clients:
+            return
+        for index, loop in enumerate(self.loops):
+            # compared packed, an unknown temperature is a NaN
+            state = frame(STATE, _state.pack(index, *self._state_of(loop)))
+            ready = []
+            for client in clients:
+                stream = client.streams[index]
+                if state != stream.state:
+                    stream.state = state
+                    client.send_frame(state)
+                if client.congested:
+                    throttled.inc()
+                else:
+                    ready.append(client)
+            if not ready:
+                continue
+            # one snapshot for all clients, from the one furthest behind
+            counts = [client.streams[index].count for client in ready]
+            since = None if None in counts else min(counts)
+            count, data = loop.history.snapshot(since=since)
+            columns = np.array([data[name] for name in loop.history.columns])
+            for client in ready:
+                self._send_samples(client, index, count, columns)
+
+    def _state_of(self, loop):
+        lock_state = loop.lock_state
+        set_temperature = loop.cooler.lastSetTemperature()
+        coolant_temperature = loop.cooler.coolant_temperature
+        return (-1 if lock_state is None else lock_state, int(loop.active),
+                np.nan if set_temperature is None else set_temperature,
+                np.nan if coolant_temperature is None
+                else coolant_temperature)
+
+    def _send_samples(self, client, index, count, columns):
+        stream = client.streams[index]
+        missed = count - (stream.count or 0)
+        if missed <= 0 or columns.shape[1] == 0:
+            return
+        new = columns[:, -missed:]
+        n = new.shape[1]
+        header = _samples.pack(index, count, n)
+        # a gap, the first samples or a refresh: absolute values
+        if stream.count is None or n < missed or \
+                stream.frames >= self.keyframe_interval:
+            client.send_frame(frame(KEY, header + new.astype('<f8').tostring()))
+            stream.values = new[:, -1].copy()
+            stream.frames = 0
+        else:
+            deltas = np.empty(new.shape, dtype='<f4')
+            values = stream.values
+            for i in range(n):
+                deltas[:, i] = new[:, i] - values
+                # continue from what the client adds up
+                values = values + deltas[:, i]
+            client.send_frame(frame(DELTA, header + deltas.tostring()))
+            stream.values = values
+            stream.frames += 1
+        stream.count = count
+
+    def shutdown(self):
+        """ Disconnect the clients and stop the thread """
+        self._running = False
+        self._thread.join()
+
+
+def _receive(sock, size):
+    data = ''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError('Telemetry server closed the connection')
+        data += chunk
+    return data
+
+
+def read_frames(sock):
+    """ Decode the frames of a TelemetryServer from the connected socket sock.
+
+    Yields ('hello', None, [(name, columns), ...]) first, then (loop, count,
+    dict of column arrays) for the samples and (loop, 'state', dict) for the
+    states, with loop the index of the loop.
+    """
+    columns = []
+    values = []
+    while True:
+        type, length = _header.unpack(_receive(sock, _header.size))
+        payload = _receive(sock, length)
+        if type == HELLO:
+            for line in payload[2:].split('\n'):
+                name, names = line.rsplit(':', 1)
+                columns.append((name, tuple(names.split(','))))
+                values.append(None)
+            yield 'hello', None, columns
+        elif type == STATE:
+            loop, lock_state, active, set_temperature, coolant_temperature \
+                = _state.unpack(payload)
+            yield loop, 'state', {
+                'lock_state': None if lock_state < 0 else lock_state,
+                'active': bool(active), 'set_temperature': set_temperature,
+                'coolant_temperature': coolant_temperature}
+        elif type in (KEY, DELTA):
+            loop, count, n = _samples.unpack(payload[:_samples.size])
+            names = columns[loop][1]
+            dtype = '<f8' if type == KEY else '<f4'
+            data = np.frombuffer(payload[_samples.size:], dtype=dtype)
+            data = data.reshape(len(names), n).astype(np.float64)
+            if type == DELTA:
+                # add up in the order of the server, which has the same sums
+                value = values[loop]
+                for i in range(n):
+                    value = value + data[:, i]
+                    data[:, i] = value
+            values[loop] = data[:, -1]
+            yield loop, count, dict(zip(names, data))
+
+
+if __name__ == '__main__':
+    import sys
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 9200
+    connection = socket.create_connection(('127.0.0.1', port))
+    for loop, count, data in read_frames(connection):
+        if loop == 'hello':
+            print 'Loops:', data
+        elif count == 'state':
+            print loop, data
+        else:
+            print loop, count, dict((name, column[-1])
+                                    for name, column in data.items())
@@ -1,39 +1,88 @@
-from daqmx_channel import daqmx_channel_in
-from T255Controller import T255Controller
+from daqmx_channel import daqmx_channel_in, BufferPool
+from T255Controller import T255Controller, limit_hits
+from lockdetector import LockDetector
+from scheduler import Scheduler, monotonic
+from archive import TelemetryArchive
+from lockcapture import LockLossCapture
+from acquisitionpolicy import AdaptiveAcquisition
+from spectrum import StreamingPSD
+from thermalmodel import ThermalModel
+from telemetryserver import TelemetryServer
+from history import CircularArray, History
+import metrics
+from metrics import registry, timed
 import time
 import logging
 logging.basicConfig(logLevel = logging.DEBUG)
 import threading
+import ctypes
 import numpy as np
 import sys
 
 
-class CircularArray:
-    def __init__(self, length):
-        """" Create a circular array of length length """
-        self.length = length
+def mean_std(data):
+    """ Return the mean and standard deviation of a 1d array.
 
-        self._array = np.array(int(self.length)*[None])
-        self._last_key = 0
+    Uses the sum and the sum of squares, so no temporary arrays are created
+    as with data.mean() and data.std().
+    """
+    n = len(data)
+    mean = data.sum() / n
+    variance = data.dot(data) / n - mean * mean
+    return mean, np.sqrt(max(variance, 0.))
 
-    def __setitem__(self, key, item):
-        
-        modified_key = key % self.length
-        self._last_key = modified_key
-        self._array[modified_key] = item
 
-    def __getitem__(self, key):
-        if key < 0:
-            key = self._last_key + key
+def history_columns_for(psd_bands):
+    """ Columns of the History of a feedbackLoop: time, signal and the
+    power in every band of psd_bands """
+    return ('time', 'signal') + tuple('band%i' % i
+                                      for i in range(len(psd_bands)))
+
+
+lockbox_status_time = registry.histogram('feedback_lockbox_status_seconds',
+                                         'Duration of lockbox_status')
+feedback_time = registry.histogram('feedback_perform_feedback_seconds',
+                                   'Duration of performFeedback')
+lock_transitions = registry.counter('feedback_lock_transitions_total',
+                                    'Changes of the lock state')
+lock_losses = registry.counter('feedback_lock_losses_total',
+                               'Changes of the lock state to out of lock')
+
+
+class LoopState(object):
+    """ Active flag and lock state of a feedbackLoop.
+
+    Kept in ctypes values so they can be shared with another process by
+    passing multiprocessing.RawValue objects.
+    """
+    def __init__(self, active=None, lock_state=None):
+        if active is None:
+            active = ctypes.c_bool(True)
+        if lock_state is None:
+            lock_state = ctypes.c_int(-1)
+        self._active = active
+        self._lock_state = lock_state  # -1 means unknown
+
+    def _get_active(self):
+        return self._active.value
 
-        modified_key = key % self.length
-        return self._array[modified_key]
+    def _set_active(self, value):
+        self._active.value = bool(value)
 
-    def toArray(self):
-        return self._array
+    active = property(_get_active, _set_active)
 
-    def __str__(self):
-        return self._array.__str__()
+    def _get_lock_state(self):
+        value = self._lock_state.value
+        if value < 0:
+            return None
+        return value
+
+    def _set_lock_state(self, value):
+        if value is None:
+            value = -1
+        self._lock_state.value = value
+
+    lock_state = property(_get_lock_state, _set_lock_state)
 
 
 class feedbackLoop(threading.Thread):
@@ -43,84 +92,326 @@ class feedbackLoop(threading.Thread):
     min_signal = 2.2
     max_signal = 4.0
     length_signals = 200 # the number of last signals to keep
+    num_samples = 10 # number of samples used for the mean of the signal
+    lock_window = 10 # number of most recent samples used to judge the lock state
+    out_of_lock_std = 0.3 # v. above this std the lockbox is out of lock
+    not_locking_std = 0.005 # v. below this std the lockbox is not locking
+    lock_hysteresis = 0.1 # relative margin before leaving a lock state
+    psd_bands = ((50., 500.), (500., 2000.), (2000., 5000.)) # Hz. bands of the PID output spectrum, a history column each
+    max_band_power = None # V^2 per band of psd_bands, above it a locking lockbox counts as out of lock (an oscillating PID). None to disable
     PID_within_bounds_time = 20 # number of seconds that the signal has to be within bounds before the feedback is active. (Sort of enhanced deadtime after changing the temperature)
+    model_based_correction = False # one correction of the size a fitted thermal model predicts, see thermalmodel.py
+    model_gain = 2. # V/degree. initial guess of the response of the signal to the set temperature
+    model_time_constant = 120. # s. initial guess of the time constant of that response
+    model_settle_time = 3. # time constants to wait for a model-based correction before correcting again
+    acquisition_period = 0.15 # s. period of reading the DAQ
+    lock_period = 0.15 # s. period of deciding the lock state
+    feedback_period = 0.15 # s. period of the chiller corrections
+    archive_directory = 'telemetry' # directory of the telemetry archive, None to disable
+    archive_raw = False # also archive every raw sample (16 bytes per sample)
+    capture_directory = 'lock_losses' # raw samples around every lock loss, None to disable
+    capture_pre_time = 1. # s. raw samples kept from before a lock loss
+    capture_post_time = 1. # s. raw samples captured after a lock loss
+    metrics_port = None # port of the local http metrics endpoint, None to disable
+    telemetry_port = None # port of the local telemetry stream, see telemetryserver.py, None to disable
+    adaptive_acquisition = False # read sparsely while well locked, densely near the bounds, see acquisitionpolicy.py
+    telemetry_columns = ('time', 'signal', 'std', 'lock_state',
+                         'set_temperature', 'coolant_temperature')
     
-    def __init__(self):
+    def __init__(self, history=None, state=None, PID_output=None, cooler=None, scheduler=None, name='',
+                 **settings):
+        """ Connect to the DAQ and the chiller.
+
+        arguments:
+        history    -- History with history_columns to record to, e.g. in
+                      shared memory
+        state      -- LoopState, e.g. in shared memory
+        PID_output -- input to read instead of channel 0
+        cooler     -- regulator instead of the T255 on COM11
+        scheduler  -- add the stages to this scheduler instead of running
+                      an own one
+        name       -- name of the loop, for the logs
+        settings   -- values for the class attributes, e.g. min_signal=2.0
+        """
         threading.Thread.__init__(self)
         self.setDaemon(True)
-
-        try:
-            self.PID_output = daqmx_channel_in(num_samples = 10, channel=0)
-        except:
-            print "Could not connect to daqmx. Aborting"
-            sys.exit(1)
-
-        try:
-            self.cooler = T255Controller()
-        except: 
-            print "Could not connect to chiller. Aborting"
-            sys.exit(1)
-
-        self.logger = logging.getLogger('feedbackLoop')
+        for key, value in settings.items():
+            if not hasattr(feedbackLoop, key):
+                raise TypeError('Unknown setting %s' % key)
+            setattr(self, key, value)
+        if state is None:
+            state = LoopState()
+        self.state = state
+        self.loop_name = name
+
+        if PID_output is None:
+            try:
+                PID_output = daqmx_channel_in(num_samples = self.num_samples,
+                                              channel=0, continuous=True)
+            except:
+                print "Could not connect to daqmx. Aborting"
+                sys.exit(1)
+        self.PID_output = PID_output
+
+        if cooler is None:
+            try:
+                cooler = T255Controller()
+            except: 
+                print "Could not connect to chiller. Aborting"
+                sys.exit(1)
+        self.cooler = cooler
+        # chiller commands run in the background, the loop keeps sampling
+        self.cooler.start_worker()
+
+        # preallocated buffers for the acquired blocks
+        self.buffers = BufferPool(self.PID_output.buffer_size)
+
+        self.logger = logging.getLogger('feedbackLoop' +
+                                        (name and '.' + name))
         self.logger.setLevel(logging.INFO)
 
-        self.active = True
-        self.t0 = time.time()
+        self.t0 = monotonic()
+        # offset to turn the monotonic clock into wall clock time stamps
+        self.wall_offset = time.time() - monotonic()
         # start assuming that the PID is within bounds
         self.PID_within_bounds = True
-
-        self.signal_history = CircularArray(self.length_signals)
-        self.time_history = CircularArray(self.length_signals)
-
+        self.model = None
+        if self.model_based_correction:
+            self.model = ThermalModel(self.model_gain,
+                                      self.model_time_constant)
+        self._model_correction_time = None
+        # why the model does not correct: None, 'zero' or 'limit'
+        self._model_hold = None
+        self.block = None
+
+        self.lock_detector = LockDetector(window=self.lock_window,
+                                          out_of_lock_std=self.out_of_lock_std,
+                                          not_locking_std=self.not_locking_std,
+                                          hysteresis=self.lock_hysteresis,
+                                          max_band_power=self.max_band_power)
+
+        # power of the PID output in psd_bands
+        self.spectrum = StreamingPSD(self.PID_output.clockspeed,
+                                     bands=self.psd_bands)
+
+        if history is None:
+            history = History(self.history_columns, self.length_signals)
+        elif history.columns != self.history_columns:
+            raise ValueError('History columns %s do not match psd_bands' %
+                             (history.columns,))
+        self.history = history
+        self.signal_history = history['signal']
+        self.time_history = history['time']
+
+        self.archive = None
+        self.raw_archive = None
+        if self.archive_directory is not None:
+            self.archive = TelemetryArchive(self.archive_directory,
+                                            self.telemetry_columns)
+            if self.archive_raw:
+                self.raw_archive = TelemetryArchive(self.archive_directory,
+                                                    ('time', 'voltage'),
+                                                    prefix='raw')
+                self._set_sample_offsets()
+                self._raw_rows = np.zeros((2, self.PID_output.buffer_size))
+
+        self.acquisition_policy = None
+        if self.adaptive_acquisition:
+            if hasattr(self.PID_output, 'reconfigure'):
+                self.acquisition_policy = AdaptiveAcquisition()
+            else:
+                # the clock of an input shared with other loops is fixed,
+                # faster stages would process its blocks again
+                self.logger.warning('Input cannot be reconfigured, no '
+                                    'adaptive acquisition')
+
+        self.capture = None
+        if self.capture_directory is not None:
+            rate = self.PID_output.clockspeed
+            max_rate = rate
+            if self.acquisition_policy is not None:
+                max_rate = max(rate,
+                               self.acquisition_policy.sparse['clockspeed'],
+                               self.acquisition_policy.dense['clockspeed'])
+            self.capture = LockLossCapture(self.capture_directory,
+                                           self.capture_pre_time,
+                                           self.capture_post_time, rate,
+                                           max_sample_rate=max_rate)
+
+        if self.metrics_port is not None:
+            metrics.serve(self.metrics_port)
+
+        self.telemetry = None
+        if self.telemetry_port is not None:
+            self.telemetry = TelemetryServer([self], self.telemetry_port)
+
+        # the stages run at their own rate, in this order when due together
+        if scheduler is None:
+            scheduler = Scheduler()
+        self.scheduler = scheduler
+        prefix = name and name + '.'
+        self.tasks = [
+            self.scheduler.add(prefix + 'acquisition',
+                               self.acquisition_period, self.acquire),
+            self.scheduler.add(prefix + 'lock', self.lock_period,
+                               self.update_lock_state),
+            self.scheduler.add(prefix + 'feedback', self.feedback_period,
+                               self.regulate)]
+        # read the set and coolant temperature in the background, at once
+        # so the first correction does not have to, then to check the cache
+        self.reconcile_task = self.scheduler.add(
+            prefix + 'reconcile', self.cooler.reconcile_interval,
+            lambda: self.cooler.submit(self.cooler.reconcile))
+
+
+    @property
+    def history_columns(self):
+        return history_columns_for(self.psd_bands)
+
+    def _get_active(self):
+        return self.state.active
+
+    def _set_active(self, value):
+        self.state.active = value
+
+    active = property(_get_active, _set_active)
+
+    def _get_lock_state(self):
+        return self.state.lock_state
+
+    def _set_lock_state(self, value):
+        self.state.lock_state = value
+
+    lock_state = property(_get_lock_state, _set_lock_state)
 
     def run(self):
-        iteration = -1
-        while True:
-            if self.active:
-
-                iteration +=1
-                self.signal = self.PID_output.read_voltage()
-                self.signal_history[iteration] = self.signal.mean()
-                self.time_history[iteration] = time.time()
-
-                # check that the device is in lock
-                if self.lockbox_status() == 1:
-                    # regulate!
-                    self.performFeedback(simulate=False)
-                else:
-                    self.t0 = time.time()
-                    self.performFeedback(simulate=True)
-#                time.sleep(5)
-                time.sleep(.15)
-            else:
-                time.sleep(0.4)
+        self.scheduler.run()
 
+    def acquire(self):
+        """ Read the samples acquired since the last call """
+        if not self.active:
+            return
+        # gapless block of everything acquired since the last iteration
+        block = self.PID_output.read_available(out=self.buffers.next())
+        if block is None:
+            # a shared input that was not read since the last iteration
+            return
+        self.block = block
+        self.signal = self.block[-self.num_samples:]
+        self.signal_mean, self.signal_std = mean_std(self.signal)
+        self.spectrum.update(self.block)
+        self.lock_detector.update(self.block, self.spectrum.band_powers)
+        if self.capture is not None:
+            self.capture.add(self.block)
+        now = monotonic() + self.wall_offset
+        self.history.append(now, self.signal_mean, *self.spectrum.band_powers)
+        if self.archive is not None:
+            self.archive_telemetry(now)
+
+    def archive_telemetry(self, now):
+        """ Store the statistics of the last block, and optionally its raw
+        samples, in the archive """
+        lock_state = self.lock_state
+        set_temperature = self.cooler.lastSetTemperature()
+        coolant_temperature = self.cooler.coolant_temperature
+        self.archive.append((now, self.signal_mean, self.signal_std,
+            np.nan if lock_state is None else lock_state,
+            np.nan if set_temperature is None else set_temperature,
+            np.nan if coolant_temperature is None else coolant_temperature))
+        if self.raw_archive is not None:
+            n = len(self.block)
+            rows = self._raw_rows[:, :n]
+            np.add(self._sample_offsets[-n:], now, out=rows[0])
+            rows[1] = self.block
+            self.raw_archive.extend(rows)
+
+    def update_lock_state(self):
+        if not self.active or self.block is None:
+            return
+        previous = self.lock_state
+        self.lock_state = self.lockbox_status()
+        if previous is not None and self.lock_state != previous:
+            lock_transitions.inc()
+            if self.capture is not None:
+                self.capture.trigger(monotonic() + self.wall_offset,
+                                     previous, self.lock_state)
+            if self.lock_state == 2:
+                lock_losses.inc()
+        if self.acquisition_policy is not None:
+            self.acquisition_policy.update(self, monotonic())
+
+    def reconfigure_acquisition(self, clockspeed, num_samples, period):
+        """ Change the clock speed and samples per read of the DAQ, and
+        the period of the loop stages """
+        self.logger.info('Acquisition at %g S/s, %i samples every %g s' %
+                         (clockspeed, num_samples, period))
+        self.PID_output.reconfigure(clockspeed, num_samples)
+        self.num_samples = num_samples
+        for task in self.tasks:
+            self.scheduler.set_period(task, period)
+        self.acquisition_period = self.lock_period = \
+            self.feedback_period = period
+        if self.raw_archive is not None:
+            self._set_sample_offsets()
+        if self.capture is not None:
+            self.capture.set_sample_rate(self.PID_output.clockspeed)
+        self.spectrum.reset(self.PID_output.clockspeed)
+
+    def _set_sample_offsets(self):
+        """ Time of every sample relative to the last one of a block """
+        buffer_size = self.PID_output.buffer_size
+        self._sample_offsets = (np.arange(buffer_size) - buffer_size
+                                + 1.) / self.PID_output.clockspeed
+
+    def regulate(self):
+        if not self.active or self.lock_state is None:
+            return
+        # check that the device is in lock
+        if self.lock_state == 1:
+            if self.model is not None:
+                self.model.observe(monotonic(), self.signal_mean,
+                                   self.cooler.lastSetTemperature())
+            # regulate!
+            self.performFeedback(simulate=False)
+        else:
+            if self.model is not None:
+                self.model.reset()
+            self.t0 = monotonic()
+            self.performFeedback(simulate=True)
 
+    def timing(self):
+        """ Return the loop timing statistics (missed deadlines, jitter) per
+        stage """
+        return self.scheduler.stats()
 
+
+    @timed(lockbox_status_time)
     def lockbox_status(self):
-        """"Take a look at the last signal (self.signal) and decide wether or not the lockbox is locked. 
+        """"Decide wether or not the lockbox is locked, from the std of the
+        last lock_window samples (see LockDetector) and the power of the PID
+        output in psd_bands (see max_band_power).
         return:
             0 Lockbox is not locking
             1 Lockbox is locking
             2 Lockbox is out of lock
         """
-        std = self.signal.std()
+        # the band power limits and the hysteresis are in the detector
+        state = self.lock_detector.state
 
-        if std > 0.3:
+        if state == 2:
             self.logger.debug('Lockbox is out of lock')
-            return 2
-        elif std < 0.005:
+        elif state == 0:
             self.logger.debug('Lockbox is Not locking')
-            return 0
         else:
             self.logger.debug('Lockbox is locking')
-            return 1
+        return state
 
+    @timed(feedback_time)
     def performFeedback(self, simulate=False):
 #        print "signal: ", self.signal.mean()
 #        print "Last signal: " , self.signal_history[-1]
 
-        mean = self.signal.mean()
+        mean = self.signal_mean
 
         # 1. Check if the signal is within the bounds:
 
@@ -129,36 +420,101 @@ class feedbackLoop(threading.Thread):
 
         if mean < self.min_signal:
 
-            self.t0 = time.time()
+            self.t0 = monotonic()
             self.logger.info('Lower bound')
-            if self.PID_within_bounds:
+            if self._correct_with_model():
+                pass
+            elif self.PID_within_bounds:
                 self.logger.info('Raise baseplate temperature')
-                if not self.cooler.raise_temperature():
-                    self.logger.error("Could not raise temperature")
+                future = self.cooler.raise_temperature_async()
+                future.add_done_callback(
+                    lambda f: self._check_correction(f, 'raise'))
 
                 self.PID_within_bounds = False
             
         elif mean > self.max_signal:
             self.logger.info('Upper bound')
-            self.t0 = time.time()
+            self.t0 = monotonic()
 
-            if self.PID_within_bounds:
+            if self._correct_with_model():
+                pass
+            elif self.PID_within_bounds:
                 self.logger.info('Lower baseplate temperature')
-                if not self.cooler.lower_temperature():
-                    self.logger.error("Could not lower temperature")
+                future = self.cooler.lower_temperature_async()
+                future.add_done_callback(
+                    lambda f: self._check_correction(f, 'lower'))
                 self.PID_within_bounds = False
         else:
             # set PID within bounds if last 20 seconds were within bounds
             
-            if time.time() - self.t0 > self.PID_within_bounds_time:
+            self._model_hold = None
+            if monotonic() - self.t0 > self.PID_within_bounds_time:
                 if not self.PID_within_bounds:
                     self.logger.info('Set PID_within_bounds to True')
                 self.PID_within_bounds = True
 
 
+    def _correct_with_model(self):
+        """ Move the set temperature at once to where the thermal model
+        puts the signal in the middle of its bounds. Returns False when the
+        model is not used or not fitted yet, then the fixed steps apply """
+        model = self.model
+        set_temperature = self.cooler.lastSetTemperature()
+        if model is None or not model.ready or set_temperature is None:
+            return False
+        now = monotonic()
+        if not self.PID_within_bounds:
+            # give the last correction time to arrive in the signal
+            if self._model_correction_time is None or \
+                    now - self._model_correction_time < \
+                    self.model_settle_time * model.time_constant:
+                return True
+        wanted = model.set_point_for(0.5 * (self.min_signal +
+                                            self.max_signal),
+                                     set_temperature)
+        limited = min(max(wanted, self.cooler.lower_temperature_limit),
+                      self.cooler.higher_temperature_limit)
+        # the set point has a resolution of 0.1 degree
+        target = round(limited, 1)
+        if abs(target - set_temperature) < 0.05:
+            # report once, this repeats every period out of bounds
+            hold = 'limit' if limited != wanted else 'zero'
+            if hold != self._model_hold:
+                self._model_hold = hold
+                if hold == 'limit':
+                    limit_hits.inc()
+                    self.logger.warning('Model correction refused by the '
+                                        'temperature limits')
+                else:
+                    self.logger.info('Model correction rounds to zero')
+            return True
+        self._model_hold = None
+        self.logger.info('Set baseplate temperature to %.1f (model gain '
+                         '%.2f V/degree, time constant %.0f s)' %
+                         (target, model.gain, model.time_constant))
+        future = self.cooler.set_temperature_async(target)
+        future.add_done_callback(lambda f: self._check_correction(f, 'set'))
+        self.PID_within_bounds = False
+        self._model_correction_time = now
+        return True
+
+    def _check_correction(self, future, action):
+        """ Called by the chiller worker when a correction finished """
+        if future.exception() is not None:
+            self.logger.error("Could not %s temperature: %s" %
+                              (action, future.exception()))
+        elif future.result() is False:
+            self.logger.error("Could not %s temperature" % action)
+
     def __del__(self):
         print "Cleaning up!" 
         self.PID_output.cleanup()
+        if self.archive is not None:
+            self.archive.flush()
+        if self.raw_archive is not None:
+            self.raw_archive.flush()
+        if self.capture is not None:
+            self.capture.close()
 
 
 if __name__ == '__main__':
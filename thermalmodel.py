@@ -0,0 +1,166 @@
+import math
+import numpy as np
+
+
+class ThermalModel:
+    """ Online fit of the response of the PID output to the set temperature.
+
+    The signal y and the set temperature u are averaged over consecutive
+    intervals of `interval` seconds and fitted with the first order model
+
+        y[k] = a * y[k - 1] + b0 * u[k] + b1 * u[k - 1] + c
+
+    both relative to their first values. The b0 term accounts for a set
+    point change within an interval. The gain of the signal is
+    K = (b0 + b1) / (1 - a) volt per degree and the time constant
+    tau = -interval / ln(a).
+
+    The fit is recursive least squares with forgetting factor `forgetting`
+    and the simulated instead of the measured previous signal as instrument,
+    so the noise on the signal does not pull tau and K down. Without set
+    point changes the data say nothing about K, so the forgetting is
+    switched off when the covariance grows beyond max_covariance, which
+    keeps the estimate from running away between corrections.
+
+    Only samples taken while locked are used. The model is ready once it
+    has seen a set point change, the fit is physical (a positive gain and a
+    time constant between interval and max_time_constant), and K and tau
+    have changed by less than `tolerance` over the last settle_samples
+    intervals.
+
+    Example:
+    model = ThermalModel(gain=2., time_constant=120.)
+    model.observe(t, signal, set_temperature)  # every iteration
+    if model.ready:
+        new_set_temperature = model.set_point_for(3.1, set_temperature)
+    """
+
+    def __init__(self, gain=2., time_constant=120., interval=1.,
+                 forgetting=0.999, max_covariance=1e3, max_time_constant=3600.,
+                 settle_samples=300, tolerance=0.1):
+        """
+        arguments:
+        gain, time_constant -- initial guess of K (V/degree) and tau (s)
+        interval            -- s to average the signal over per fit sample
+        settle_samples      -- fit samples over which K and tau have to be
+                               stable before the model is ready
+        tolerance           -- allowed relative spread of K and tau over those
+        """
+        self.interval = interval
+        self.forgetting = forgetting
+        self.max_covariance = max_covariance
+        self.max_time_constant = max_time_constant
+        self.tolerance = tolerance
+
+        a = math.exp(-interval / time_constant)
+        self.theta = np.array([a, 0., gain * (1 - a), 0.])
+        # a broad prior, the guesses are only a starting point; the set
+        # temperature changes by tenths of a degree, so b is large
+        self.P = np.diag([1., 100., 100., 1.])
+        self.y0 = None
+        self.u0 = None
+        self.changes = 0  # set point changes seen while fitting
+        self.samples = 0  # fit samples since the first change
+        # K and tau of the last settle_samples fit samples
+        self._estimates = np.zeros((2, int(settle_samples)))
+
+        self._start = None
+        self._y_sum = 0.
+        self._u_sum = 0.
+        self._n = 0
+        self._previous = None  # (y, u) of the previous interval
+        self._simulated = 0.  # model output of the previous interval
+
+    @property
+    def gain(self):
+        a, b0, b1, c = self.theta
+        return (b0 + b1) / (1 - a) if a != 1 else float('inf')
+
+    @property
+    def time_constant(self):
+        a = self.theta[0]
+        if not 0 < a < 1:
+            return float('inf')
+        return -self.interval / math.log(a)
+
+    @property
+    def converged(self):
+        """ True when K and tau were stable over the last settle_samples """
+        if self.samples < self._estimates.shape[1]:
+            return False
+        spread = self._estimates.max(axis=1) - self._estimates.min(axis=1)
+        return bool(np.all(spread <= self.tolerance *
+                           np.abs(np.median(self._estimates, axis=1))))
+
+    @property
+    def ready(self):
+        return (self.changes > 0 and self.gain > 0 and
+                self.interval <= self.time_constant <= self.max_time_constant
+                and self.converged)
+
+    def reset(self):
+        """ Forget the current interval, e.g. when the lock is lost """
+        self._start = None
+        self._y_sum, self._u_sum, self._n = 0., 0., 0
+        self._previous = None
+
+    def observe(self, t, signal, set_temperature):
+        """ Add a signal mean at time t, taken while locked """
+        if set_temperature is None:
+            return
+        if self.y0 is None:
+            self.y0, self.u0 = signal, set_temperature
+        if self._start is not None and t - self._start >= self.interval:
+            # close the interval, the next one starts where it ended
+            if self._n:
+                self._add(self._y_sum / self._n - self.y0,
+                          self._u_sum / self._n - self.u0)
+            self._y_sum, self._u_sum, self._n = 0., 0., 0
+            self._start += self.interval
+            if t - self._start >= self.interval:
+                # an interval without samples breaks the model, start over
+                self.reset()
+        if self._start is None:
+            self._start = t
+        self._y_sum += signal
+        self._u_sum += set_temperature
+        self._n += 1
+
+    def _add(self, y, u):
+        if self._previous is not None:
+            y_previous, u_previous = self._previous
+            if abs(u - u_previous) > 1e-6:
+                self.changes += 1
+            phi = np.array([y_previous, u, u_previous, 1.])
+            # instrument: the same regressor with the simulated signal,
+            # which is not correlated with the measurement noise
+            z = np.array([self._simulated, u, u_previous, 1.])
+            error = y - phi.dot(self.theta)
+            P_z = self.P.dot(z)
+            forgetting = self.forgetting
+            if np.trace(self.P) > self.max_covariance:
+                forgetting = 1.
+            gain = P_z / (forgetting + phi.dot(P_z))
+            self.theta += gain * error
+            self.P = (self.P - np.outer(gain, phi.dot(self.P))) / forgetting
+            self._simulated = z.dot(self.theta)
+            if self.changes:
+                self._estimates[:, self.samples % self._estimates.shape[1]] \
+                    = self.gain, self.time_constant
+                self.samples += 1
+        else:
+            self._simulated = y
+        self._previous = (y, u)
+
+    def steady_state(self, set_temperature):
+        """ Signal the model settles at with set_temperature """
+        a, b0, b1, c = self.theta
+        return self.y0 + ((b0 + b1) * (set_temperature - self.u0) + c) / \
+            (1 - a)
+
+    def set_point_for(self, signal, set_temperature):
+        """ Set temperature at which the model settles at signal, starting
+        from set_temperature. Includes the part of earlier corrections that
+        has not arrived in the signal yet """
+        return set_temperature + (signal - self.steady_state(
+            set_temperature)) / self.gain